@@ -1,63 +1,38 @@
 import os
 import numpy as np
-import pandas as pd
 import tensorflow as tf
 from sklearn.metrics import accuracy_score, precision_score, recall_score
 from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import confusion_matrix, classification_report
-from tqdm import tqdm
-import sqlite3
-from collections import defaultdict
-from featureExPy import EegFeatureExtractor
-from eeg_preprocessing import preprocess_matrix
-import random
+from feature_store import load_split
+from finetune_sessions import (INPUT_ROWS, SELECTED_FEATURES, balanced_session_split, featurize_block,
+                               featurize_finetune_sessions, split_finetune_data)
+from fold_runner import run_folds
+from instrumentation import instrumented, stage
+from numpy_model import NumpySeleneModel, export_npz
 import json
 
 
 # --- Dataset Pre Processing ---
 NUM_CLASSES = 4
-INPUT_ROWS = 6  # lines to use in each matrix: from 2 to 7 (6 channels, line 1 is title line, 8 is channel7 not used)
-# Selected features used in the app
-SELECTED_FEATURES = [
-    "Abs_beta_Power", "RMS", "POWER", "Theta_to_Alpha_Ratio", "Rel_delta_Power", "VAR",
-    "Rel_theta_Power", "FORM FACTOR", "Abs_theta_Power", "Abs_alpha_Power", "PULSE INDICATOR",
-    "Spectral_Entropy", "Rel_alpha_Power", "Theta_Alpha_to_Beta_Ratio", "Abs_delta_Power"
-]
+# INPUT_ROWS and SELECTED_FEATURES (the features used in the app) are defined in finetune_sessions.py
 DATA_PATH = './'
-
-def load_data_from_folder(folder_path):
-    X_list = []
-    y_list = []
-
+FEATURE_CACHE_DIR = 'feature-cache'  # features of the selene-db blocks, see feature_cache.py
+FOLD_WORKERS = min(10, os.cpu_count() or 1)  # cross validation folds running in parallel, 1 to run them in this process
+PARSE_WORKERS = 1  # processes parsing the .xlsx files of a split when its feature store is compiled (feature_store.py)
+FINETUNE_SPLIT_SEED = None  # None for a random fine tuning split in every fold, an int for reproducible splits
+# Fine tuning trains hl3 and tail on the hl2 activations computed once per sample (see run_training)
+FINETUNE_CACHED_BACKBONE = True
+BACKBONE_LAYERS = ['head', 'hl1', 'hl2']  # frozen during fine tuning
+HEAD_LAYERS = ['hl3', 'tail']
+
+def load_data_from_folder(folder_path, workers=PARSE_WORKERS):
     # Identification of the type: train/validation/test analyzing the name
     dataset_type = os.path.basename(folder_path)  # it takes 'train', 'validation', 'test'
     labels_file = os.path.join(os.path.dirname(folder_path), f"{dataset_type}_labels.csv")
 
-    labels_df = pd.read_csv(labels_file, skiprows=1, header=None, names=["file", "label"])
-    label_dict = dict(zip(labels_df["file"], labels_df["label"]))
-
-    file_names = [f for f in os.listdir(folder_path) if f.endswith('.xlsx')]
-
-    for file_name in tqdm(file_names, desc=f"Loading {folder_path} data"):
-        file_path = os.path.join(folder_path, file_name)
-
-        if file_name not in label_dict:
-            print(f"{file_name} skipped (no label).")
-            continue
-
-        df_full = pd.read_excel(file_path, engine='openpyxl')
-        selected_cols = [col for col in df_full.columns if col in SELECTED_FEATURES]
-        df_selected = df_full.loc[0:, selected_cols]
-
-        data_array = df_selected.values
-        if data_array.shape != (INPUT_ROWS, len(SELECTED_FEATURES)):
-            raise ValueError(f"{file_name} shape mismatch: {data_array.shape}")
-
-        X_list.append(data_array.flatten())
-        y_list.append(label_dict[file_name])
-
-    X = np.array(X_list)
-    y = np.array(y_list)
+    # The .xlsx files are compiled once into a memory-mapped store, rebuilt when they change (see feature_store.py)
+    X, y, _ = load_split(folder_path, labels_file, SELECTED_FEATURES, INPUT_ROWS, workers)
     return X, y
 
 
@@ -87,6 +62,12 @@ class SeleneModel(tf.Module):
         tf.TensorSpec([None, 4], tf.float32),
     ])
     def train(self, x, y):
+        loss = self.train_step(x, y)
+        reshaped_loss = tf.reshape(loss,[1])
+        return {"loss": reshaped_loss}
+
+    # One SGD step on a batch, shared by train and train_epoch
+    def train_step(self, x, y):
         with tf.GradientTape() as tape:
             logits = self.model(x, training=True)
             loss = tf.reduce_mean(
@@ -95,8 +76,69 @@ class SeleneModel(tf.Module):
         gradients = tape.gradient(loss, self.model.trainable_variables)
         clipped_gradients = [tf.clip_by_norm(g, 1.0) for g in gradients]
         self.optimizer.apply_gradients(zip(clipped_gradients, self.model.trainable_variables))
-        reshaped_loss = tf.reshape(loss,[1])
-        return {"loss": reshaped_loss}
+        return loss
+
+    # A whole epoch of batch_size=1 steps (the same updates of calling train once per sample) in a single graph,
+    # without going back to python between samples. Returns the loss of every step
+    @tf.function(input_signature=[
+        tf.TensorSpec([None, 90], tf.float32),
+        tf.TensorSpec([None, 4], tf.float32),
+    ])
+    def train_epoch(self, x, y):
+        n = tf.shape(x)[0]
+        losses = tf.TensorArray(tf.float32, size=n)
+        for i in tf.range(n):
+            loss = self.train_step(x[i:i + 1], y[i:i + 1])
+            losses = losses.write(i, loss)
+        return {"loss": losses.stack()}
+
+    # Freezes (trainable=False) or unfreezes the layers in names. train and train_epoch keep the trainable variables
+    # of their first trace, so they are replaced by new graphs, traced at their next call with the layers of now
+    def set_trainable(self, names, trainable):
+        for name in names:
+            self.model.get_layer(name).trainable = trainable
+        for name in ("train", "train_epoch"):
+            function = getattr(SeleneModel, name)
+            setattr(self, name, tf.function(function.python_function.__get__(self),
+                                            input_signature=function.input_signature))
+
+    # Output of the frozen layers (the 32 hl2 activations), computed once per sample when fine tuning with the cache
+    @tf.function(input_signature=[
+        tf.TensorSpec([None, 90], tf.float32),
+    ])
+    def backbone(self, x):
+        for name in BACKBONE_LAYERS:
+            x = self.model.get_layer(name)(x, training=False)
+        return x
+
+    # One SGD step of hl3 and tail only, from the backbone output h: the update of train_step with the backbone frozen
+    def head_step(self, h, y):
+        layers = [self.model.get_layer(name) for name in HEAD_LAYERS]
+        variables = [variable for layer in layers for variable in layer.trainable_variables]
+        with tf.GradientTape() as tape:
+            logits = h
+            for layer in layers:
+                logits = layer(logits, training=True)
+            loss = tf.reduce_mean(
+                tf.keras.losses.categorical_crossentropy(y, logits, from_logits=True)
+            )
+        gradients = tape.gradient(loss, variables)
+        clipped_gradients = [tf.clip_by_norm(g, 1.0) for g in gradients]
+        self.optimizer.apply_gradients(zip(clipped_gradients, variables))
+        return loss
+
+    # train_epoch on cached backbone outputs
+    @tf.function(input_signature=[
+        tf.TensorSpec([None, 32], tf.float32),
+        tf.TensorSpec([None, 4], tf.float32),
+    ])
+    def train_head_epoch(self, h, y):
+        n = tf.shape(h)[0]
+        losses = tf.TensorArray(tf.float32, size=n)
+        for i in tf.range(n):
+            loss = self.head_step(h[i:i + 1], y[i:i + 1])
+            losses = losses.write(i, loss)
+        return {"loss": losses.stack()}
 
     @tf.function(input_signature=[
         tf.TensorSpec([None, 90], tf.float32),
@@ -108,8 +150,9 @@ class SeleneModel(tf.Module):
 
     @tf.function(input_signature=[tf.TensorSpec(shape=[], dtype=tf.string)])
     def save(self, checkpoint_path):
-        tensor_names = [weight.name for weight in self.model.weights]
-        tensors_to_save = [weight.read_value() for weight in self.model.weights]
+        # path (Keras 3) is the unique name of a weight, name is the last part only; tf.Variable has no path
+        tensor_names = [getattr(weight, "path", weight.name) for weight in self.model.weights]
+        tensors_to_save = [tf.convert_to_tensor(weight) for weight in self.model.weights]
         tf.raw_ops.Save(
             filename=checkpoint_path,
             tensor_names=tensor_names,
@@ -123,48 +166,84 @@ class SeleneModel(tf.Module):
         for var in self.model.weights:
             restored = tf.raw_ops.Restore(
                 file_pattern=checkpoint_path,
-                tensor_name=var.name,
-                dt=var.dtype
+                tensor_name=getattr(var, "path", var.name),
+                dt=tf.as_dtype(var.dtype)
             )
+            # Restore gives a tensor of unknown shape, Keras 3 variables only accept a known one
+            restored = tf.reshape(restored, var.shape)
             var.assign(restored)
-            restored_tensors[var.name] = restored
+            restored_tensors[getattr(var, "path", var.name)] = restored
         return restored_tensors
     
 #function for loop training
-def run_training(model, x_train, y_train, x_val=None, y_val=None, batch_size=1, epochs=10, patience=3):
+# compiled=True (only with batch_size=1) runs every epoch with model.train_epoch, in a single graph: the samples are
+# taken in the same shuffled order, so with the same seed the weights are the same of the step by step loop.
+# Step losses are printed every log_every steps (0 to print only the epoch averages).
+# cached_backbone=True (fine tuning, only with batch_size=1) computes the output of the frozen head, hl1 and hl2 once
+# for every sample and trains only hl3 and tail on it, an epoch at a time as compiled: same order and same updates
+# of the step by step loop with those layers frozen, without their forward and backward pass in every step.
+def run_training(model, x_train, y_train, x_val=None, y_val=None, batch_size=1, epochs=10, patience=3,
+                 compiled=False, seed=None, log_every=1, cached_backbone=False):
+    if (compiled or cached_backbone) and batch_size != 1:
+        raise ValueError("compiled and cached_backbone training are available only with batch_size=1")
+
     dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-    dataset = dataset.shuffle(buffer_size=len(x_train)).batch(batch_size)
+    dataset = dataset.shuffle(buffer_size=len(x_train), seed=seed).batch(batch_size)
+    # Same shuffle of the dataset above, on the indexes of the samples
+    order = tf.data.Dataset.range(len(x_train)).shuffle(buffer_size=len(x_train), seed=seed).batch(len(x_train))
+    if compiled:
+        # Optimizer variables must exist before the first graph that updates them
+        model.optimizer.build(model.model.trainable_variables)
+    if cached_backbone:
+        with stage("backbone", x_train.nbytes):
+            h_train = model.backbone(x_train)
+        if not model.optimizer.built:
+            model.optimizer.build(model.model.trainable_variables)
 
     best_val_loss = float('inf')
     patience_counter = 0
 
     for epoch in range(epochs):
         print(f"\nEpoch {epoch + 1}/{epochs}")
-        epoch_loss = []
 
-        for step, (batch_x, batch_y) in enumerate(dataset):
-            result = model.train(batch_x, batch_y)
-            batch_loss = result["loss"].numpy()
-            epoch_loss.append(batch_loss)
-            print(f"  Step {step + 1}: loss = {batch_loss.item():.4f}")
-
-        avg_loss = sum(epoch_loss) / len(epoch_loss)
-        print(f"Epoch {epoch + 1} average training loss: {avg_loss.item():.4f}")
+        if cached_backbone:
+            indexes = next(iter(order))
+            with stage("train_head_epoch", h_train.shape[0] * h_train.shape[1] * 4):
+                epoch_loss = model.train_head_epoch(tf.gather(h_train, indexes),
+                                                    tf.gather(y_train, indexes))["loss"].numpy()
+        elif compiled:
+            indexes = next(iter(order))
+            with stage("train_epoch", x_train.nbytes):
+                epoch_loss = model.train_epoch(tf.gather(x_train, indexes), tf.gather(y_train, indexes))["loss"].numpy()
+        else:
+            epoch_loss = []
+            for batch_x, batch_y in dataset:
+                with stage("train_step"):
+                    epoch_loss.append(model.train(batch_x, batch_y)["loss"].numpy().item())
+            epoch_loss = np.array(epoch_loss)
+
+        if log_every:
+            for step in range(0, len(epoch_loss), log_every):
+                print(f"  Step {step + 1}: loss = {epoch_loss[step]:.4f}")
+
+        avg_loss = np.mean(epoch_loss)
+        print(f"Epoch {epoch + 1} average training loss: {avg_loss:.4f}")
 
         # Early stopping code, checking for validation data
         if x_val is not None and y_val is not None:
-            logits = model.model(x_val, training=False)
-            probs = tf.nn.softmax(logits)
-            val_loss = tf.reduce_mean(
-                tf.keras.losses.categorical_crossentropy(y_val, probs)
-            ).numpy()
+            with stage("evaluate", x_val.nbytes):
+                logits = model.model(x_val, training=False)
+                probs = tf.nn.softmax(logits)
+                val_loss = tf.reduce_mean(
+                    tf.keras.losses.categorical_crossentropy(y_val, probs)
+                ).numpy()
 
-            y_true = np.argmax(y_val, axis=1)
-            y_pred = np.argmax(probs.numpy(), axis=1)
+                y_true = np.argmax(y_val, axis=1)
+                y_pred = np.argmax(probs.numpy(), axis=1)
 
-            val_accuracy = accuracy_score(y_true, y_pred)
-            val_precision = precision_score(y_true, y_pred, average='macro', zero_division=0)
-            val_recall = recall_score(y_true, y_pred, average='macro', zero_division=0)
+                val_accuracy = accuracy_score(y_true, y_pred)
+                val_precision = precision_score(y_true, y_pred, average='macro', zero_division=0)
+                val_recall = recall_score(y_true, y_pred, average='macro', zero_division=0)
 
             print(f"Validation\n    loss    : {val_loss:.4f}\n    accuracy: {val_accuracy:.4f}\n    precision: {val_precision:.4f}\n    recall   : {val_recall:.4f}")
 
@@ -184,6 +263,7 @@ def run_training(model, x_train, y_train, x_val=None, y_val=None, batch_size=1,
 
 
 # Function for final test
+@instrumented("evaluate", bytes_arg=1)
 def evaluate_model(model, x_test, y_test):
     logits = model.model(x_test, training=False)
     probs = tf.nn.softmax(logits)
@@ -221,197 +301,192 @@ def evaluate_model(model, x_test, y_test):
     print(classification_report(y_true, y_pred, zero_division=0))
 
 
-def balanced_session_split(cursor, num_classes=4, total_test_sessions=14):
-    cursor.execute("SELECT DISTINCT session_id FROM SampleEeg ORDER BY session_id")
-    all_session_ids = [row[0] for row in cursor.fetchall()]
-
-    class_to_sessions = defaultdict(list)
-    for session_id in all_session_ids:
-        cursor.execute("SELECT tiredness FROM SampleEeg WHERE session_id = ? LIMIT 1", (session_id,))
-        tiredness = cursor.fetchone()[0]
-        if tiredness < num_classes:
-            class_to_sessions[tiredness].append(session_id)
-
-    test_sessions = []
-    train_sessions = []
-
-    for tiredness in range(num_classes):
-        sessions = class_to_sessions[tiredness]
-        if len(sessions) < 2:
-            raise ValueError(f"Classe {tiredness} ha meno di 2 sessioni disponibili.")
-        selected_test = random.choice(sessions)
-        test_sessions.append(selected_test)
-        remaining = [s for s in sessions if s != selected_test]
-        train_sessions.extend(remaining)
-
-    remaining_test_needed = total_test_sessions - num_classes
-    if remaining_test_needed > 0:
-        extra_test = random.sample(train_sessions, remaining_test_needed)
-        for s in extra_test:
-            train_sessions.remove(s)
-        test_sessions.extend(extra_test)
-
-    return train_sessions, test_sessions
-
-#For the test, in selene-db, 34 16000-samples sessions were created
-def load_finetune_and_test_data_updated(db_path, block_size=16000):
-    x_finetune, y_finetune = [], []
-    x_test, y_test = [], []
-
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT session_id FROM SampleEeg ORDER BY session_id")
-    session_ids = [row[0] for row in cursor.fetchall()]
-
-    # This function guarantees at least one session for each label in train and test sets
-    training_sessions, testing_sessions = balanced_session_split(cursor)
-
-    for session_id in session_ids:
-        cursor.execute("SELECT tiredness FROM SampleEeg WHERE session_id = ? LIMIT 1", (session_id,))
-        tiredness = cursor.fetchone()[0]
-
-        cursor.execute("""
-            SELECT channel_c1, channel_c2, channel_c3, channel_c4, channel_c5, channel_c6
-            FROM SampleEeg
-            WHERE session_id = ?
-            ORDER BY timestamp
-            LIMIT ?
-        """, (session_id, block_size))
-        all_rows = cursor.fetchall()  
-
-        raw_data = np.array(all_rows)
-        if raw_data.shape[0] < block_size:
-            continue
-
-        block = raw_data.T  # shape is (6, 16000)
-        # Preprocessing using Savitzky-Golay filter and Wavelet trasform
-        block = preprocess_matrix(block)
-        # Features extraction
-        features_matrix = EegFeatureExtractor.extract_features_matrix(block, 500)
-        flat_vector = EegFeatureExtractor.flatten_features_matrix(features_matrix)
-
-        if session_id in training_sessions:
-            x_finetune.append(flat_vector)
-            y_finetune.append(tiredness)
-        elif session_id in testing_sessions:
-            x_test.append(flat_vector)
-            y_test.append(tiredness)
-
-    conn.close()
-    return np.array(x_finetune), np.array(y_finetune), np.array(x_test), np.array(y_test)
-
-
-# --- Main in wich the code is addestred ---
-if __name__ == "__main__":
-    all_accuracies = []
-    all_precisions = []
-    all_recalls = []
-    all_f1s = []
-    fine_tune_accuracies = []
-    fine_tune_precisions = []
-    fine_tune_recalls = []
-    fine_tune_f1s = []
-    fine_tune_cms = []
-    fine_tune_reports = []
-
-    # Cross validation over 10 folds (stages)
-    for fold in range(10):
-        stage_path = f"stage_{fold}"
-        print(f"\n\n========= FOLD {fold} ({stage_path}) =========")
-
-        # Loading data
-        print("Loading data...")
-        X_train, y_train_raw = load_data_from_folder(os.path.join(stage_path, "train"))
-        X_val, y_val_raw = load_data_from_folder(os.path.join(stage_path, "validation"))
-        X_test, y_test_raw = load_data_from_folder(os.path.join(stage_path, "test"))
-
-        y_train = preprocess_labels(y_train_raw, NUM_CLASSES)
-        y_val = preprocess_labels(y_val_raw, NUM_CLASSES)
-        y_test = preprocess_labels(y_test_raw, NUM_CLASSES)
-
-        print(f"Train shape: {X_train.shape}, {y_train.shape}")
-        print(f"Val shape  : {X_val.shape}, {y_val.shape}")
-        print(f"Test shape : {X_test.shape}, {y_test.shape}")
-
-        # Creation of the model
-        model = SeleneModel(inputShape=(X_train.shape[1],), numClasses=NUM_CLASSES)
-
-        # Training
+def load_finetune_and_test_data_updated(db_path, block_size=16000, cache_dir=None, hop=None, seed=None):
+    finetune_data = featurize_finetune_sessions(db_path, block_size, cache_dir, hop)
+    return split_finetune_data(finetune_data, seed)
+
+
+# The "train" signature of the SavedModel in saved_model_dir, run once on a probe vector, must change no weight of the
+# frozen BACKBONE_LAYERS. The SavedModel has its own copy of the variables, the weights of model are not touched
+def check_exported_train(model, saved_model_dir):
+    exported = tf.saved_model.load(saved_model_dir)
+    weights = exported.tflite_variables[:len(model.model.weights)]
+    before = [weight.numpy().copy() for weight in weights]
+    exported.signatures["train"](x=tf.ones((1, model.model.input_shape[-1])),
+                                 y=tf.one_hot([0], model.model.output_shape[-1]))
+    changed = [path for path, weight, value in zip((w.path for w in model.model.weights), weights, before)
+               if path.split("/")[-2] in BACKBONE_LAYERS and not np.array_equal(weight.numpy(), value)]
+    if changed:
+        raise RuntimeError(f"The exported train signature updates frozen weights: {', '.join(changed)}")
+
+
+# Conversion of the model to .tflite with its train, predict, save and load_weights signatures, as in Model training.py.
+# As there, head, hl1 and hl2 are frozen first: the app fine tunes only hl3 and tail
+def export_tflite(model, tflite_path="trainable_model.tflite", saved_model_dir="saved_model"):
+    model.set_trainable(BACKBONE_LAYERS, False)
+    # The converter initializes only the variables the SavedModel tracks as such: Keras 3 wraps every tf.Variable,
+    # so the underlying ones of the weights and of the optimizer are tracked on the module too
+    if not model.optimizer.built:
+        model.optimizer.build(model.model.trainable_variables)
+    model.tflite_variables = [variable.value for variable in model.model.weights + model.optimizer.variables]
+    tf.saved_model.save(model, saved_model_dir, signatures={
+        "train": model.train,
+        "predict": model.predict,
+        "save": model.save,
+        "load_weights": model.load_weights
+    })
+    check_exported_train(model, saved_model_dir)
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    converter.allow_custom_ops = True
+    converter.experimental_enable_resource_variables = True
+    tflite_model = converter.convert()
+    with open(tflite_path, "wb") as f:
+        f.write(tflite_model)
+    print(f"Model converted in {tflite_path}")
+
+
+# Fine tuning of a trained model on the training sessions of a split of finetune_data (see featurize_finetune_sessions)
+# and evaluation on its test sessions. With model_path, the fine tuned model is also written there (see numpy_model.py)
+def finetune_and_evaluate(model, finetune_data, seed=None, model_path=None, title="",
+                          cached_backbone=FINETUNE_CACHED_BACKBONE):
+    x_ft, y_ft_raw, x_test_eeg, y_test_eeg_raw = split_finetune_data(finetune_data, seed)
+
+    # Freezing layers before fine tuning
+    model.set_trainable(BACKBONE_LAYERS, False)
+
+    # Fine tuning train
+    y_ft = tf.keras.utils.to_categorical(np.array(y_ft_raw) % NUM_CLASSES, NUM_CLASSES)
+    with stage("finetune"):
+        run_training(model, x_ft.astype(np.float32), y_ft.astype(np.float32), batch_size=1, epochs=50, seed=seed,
+                     cached_backbone=cached_backbone)
+
+    # Evaluation post fine tuning
+    print("\nTest EEG dopo fine tuning:")
+    y_test_cat = tf.keras.utils.to_categorical(np.array(y_test_eeg_raw) % NUM_CLASSES, NUM_CLASSES)
+    # All the test vectors in one call of the NumPy copy of the fine tuned model, instead of one predict per vector
+    with stage("evaluate", x_test_eeg.nbytes):
+        output = NumpySeleneModel.from_model(model).predict_proba(x_test_eeg)
+        y_pred_ft = np.argmax(output, axis=1)
+        losses = tf.keras.losses.categorical_crossentropy(y_test_cat, output, from_logits=False).numpy()
+    if model_path is not None:
+        export_npz(model, model_path)
+
+    y_true_ft = np.array(y_test_eeg_raw) % NUM_CLASSES
+
+    val_loss = np.mean(losses)
+    val_accuracy = accuracy_score(y_true_ft, y_pred_ft)
+    val_precision = precision_score(y_true_ft, y_pred_ft, average='macro', zero_division=0)
+    val_recall = recall_score(y_true_ft, y_pred_ft, average='macro', zero_division=0)
+    val_f1 = 2 * (val_precision * val_recall) / (val_precision + val_recall + 1e-7)
+
+    print(f"\nFine Tuning - {title}")
+    print(f"  Loss     : {val_loss:.4f}")
+    print(f"  Accuracy : {val_accuracy:.4f}")
+    print(f"  Precision: {val_precision:.4f}")
+    print(f"  Recall   : {val_recall:.4f}")
+    print(f"  F1-Score : {val_f1:.4f}")
+
+    return {
+        "accuracy": val_accuracy, "precision": val_precision, "recall": val_recall, "f1": val_f1, "loss": val_loss,
+        "cm": confusion_matrix(y_true_ft, y_pred_ft),
+        "report": classification_report(y_true_ft, y_pred_ft, output_dict=True, zero_division=0),
+    }
+
+
+# Train, validation and test data of a fold (stage), with one-hot labels
+def load_fold_data(fold, workers=PARSE_WORKERS):
+    stage_path = f"stage_{fold}"
+    X_train, y_train_raw = load_data_from_folder(os.path.join(stage_path, "train"), workers)
+    X_val, y_val_raw = load_data_from_folder(os.path.join(stage_path, "validation"), workers)
+    X_test, y_test_raw = load_data_from_folder(os.path.join(stage_path, "test"), workers)
+
+    return {
+        "X_train": X_train, "y_train": preprocess_labels(y_train_raw, NUM_CLASSES),
+        "X_val": X_val, "y_val": preprocess_labels(y_val_raw, NUM_CLASSES),
+        "X_test": X_test, "y_test": preprocess_labels(y_test_raw, NUM_CLASSES),
+    }
+
+
+# Training, test, fine tuning and test after fine tuning of one fold. The metrics are returned, so that the folds
+# can also run in worker processes (see fold_runner.py)
+@instrumented("fold")
+def run_fold(fold, data):
+    stage_path = f"stage_{fold}"
+    print(f"\n\n========= FOLD {fold} ({stage_path}) =========")
+
+    X_train, y_train = data["X_train"], data["y_train"]
+    X_val, y_val = data["X_val"], data["y_val"]
+    X_test, y_test = data["X_test"], data["y_test"]
+
+    print(f"Train shape: {X_train.shape}, {y_train.shape}")
+    print(f"Val shape  : {X_val.shape}, {y_val.shape}")
+    print(f"Test shape : {X_test.shape}, {y_test.shape}")
+
+    # Creation of the model
+    model = SeleneModel(inputShape=(X_train.shape[1],), numClasses=NUM_CLASSES)
+
+    # Training
+    with stage("train"):
         run_training(model, X_train.astype(np.float32), y_train.astype(np.float32),
                      X_val.astype(np.float32), y_val.astype(np.float32),
                      batch_size=1, epochs=100, patience=10)
 
-        # Test of the base model
+    # Test of the base model
+    with stage("evaluate", X_test.nbytes):
         logits = model.model(X_test.astype(np.float32), training=False)
         probs = tf.nn.softmax(logits)
-        y_true = np.argmax(y_test, axis=1)
-        y_pred = np.argmax(probs.numpy(), axis=1)
-
-        acc = accuracy_score(y_true, y_pred)
-        prec = precision_score(y_true, y_pred, average='macro', zero_division=0)
-        rec = recall_score(y_true, y_pred, average='macro', zero_division=0)
-        f1 = 2 * (prec * rec) / (prec + rec + 1e-7)
-
-        print(f"\nFOLD {fold} results:")
-        print(f"  Accuracy : {acc:.4f}")
-        print(f"  Precision: {prec:.4f}")
-        print(f"  Recall   : {rec:.4f}")
-        print(f"  F1-Score : {f1:.4f}")
-
-        all_accuracies.append(acc)
-        all_precisions.append(prec)
-        all_recalls.append(rec)
-        all_f1s.append(f1)
-
-        print("\n--- FINE TUNING EEG SESSIONS ---")
-        x_ft, y_ft_raw, x_test_eeg, y_test_eeg_raw = load_finetune_and_test_data_updated("selene-db")
-
-        # Freezing layers before fine tuning
-        model.model.get_layer('head').trainable = False
-        model.model.get_layer('hl1').trainable = False
-        model.model.get_layer('hl2').trainable = False
-
-        # Fine tuning train
-        y_ft = tf.keras.utils.to_categorical(np.array(y_ft_raw) % NUM_CLASSES, NUM_CLASSES)
-        run_training(model, x_ft.astype(np.float32), y_ft.astype(np.float32), batch_size=1, epochs=50)
-
-        # Evaluation post fine tuning
-        print("\nTest EEG dopo fine tuning:")
-        y_pred_ft = []
-        losses = []
-        y_test_cat = tf.keras.utils.to_categorical(np.array(y_test_eeg_raw) % NUM_CLASSES, NUM_CLASSES)
-        for i in range(x_test_eeg.shape[0]):
-            input_vector = x_test_eeg[i].astype(np.float32).reshape(1, -1)
-            true_label = y_test_cat[i].reshape(1, -1)
-            output = model.predict(input_vector)["output"]
-            pred_class = tf.argmax(output, axis=1).numpy()[0]
-            y_pred_ft.append(pred_class)
-            loss = tf.keras.losses.categorical_crossentropy(true_label, output, from_logits=False).numpy()[0]
-            losses.append(loss)
-
-        y_pred_ft = np.array(y_pred_ft)
-        y_true_ft = np.array(y_test_eeg_raw) % NUM_CLASSES
-
-        val_loss = np.mean(losses)
-        val_accuracy = accuracy_score(y_true_ft, y_pred_ft)
-        val_precision = precision_score(y_true_ft, y_pred_ft, average='macro', zero_division=0)
-        val_recall = recall_score(y_true_ft, y_pred_ft, average='macro', zero_division=0)
-        val_f1 = 2 * (val_precision * val_recall) / (val_precision + val_recall + 1e-7)
-
-        print(f"\nFine Tuning - Fold {fold}")
-        print(f"  Loss     : {val_loss:.4f}")
-        print(f"  Accuracy : {val_accuracy:.4f}")
-        print(f"  Precision: {val_precision:.4f}")
-        print(f"  Recall   : {val_recall:.4f}")
-        print(f"  F1-Score : {val_f1:.4f}")
-
-        fine_tune_accuracies.append(val_accuracy)
-        fine_tune_precisions.append(val_precision)
-        fine_tune_recalls.append(val_recall)
-        fine_tune_f1s.append(val_f1)
-        fine_tune_cms.append(confusion_matrix(y_true_ft, y_pred_ft))
-        fine_tune_reports.append(classification_report(y_true_ft, y_pred_ft, output_dict=True, zero_division=0))
+    y_true = np.argmax(y_test, axis=1)
+    y_pred = np.argmax(probs.numpy(), axis=1)
 
+    acc = accuracy_score(y_true, y_pred)
+    prec = precision_score(y_true, y_pred, average='macro', zero_division=0)
+    rec = recall_score(y_true, y_pred, average='macro', zero_division=0)
+    f1 = 2 * (prec * rec) / (prec + rec + 1e-7)
+
+    print(f"\nFOLD {fold} results:")
+    print(f"  Accuracy : {acc:.4f}")
+    print(f"  Precision: {prec:.4f}")
+    print(f"  Recall   : {rec:.4f}")
+    print(f"  F1-Score : {f1:.4f}")
+
+    print("\n--- FINE TUNING EEG SESSIONS ---")
+    # The sessions are featurized once before the folds, only the split changes in every fold
+    seed = None if FINETUNE_SPLIT_SEED is None else FINETUNE_SPLIT_SEED + fold
+    finetune_data = {name[len("ft_"):]: data[name] for name in data if name.startswith("ft_")}
+    fine_tune = finetune_and_evaluate(model, finetune_data, seed, title=f"Fold {fold}")
+
+    return {
+        "accuracy": acc, "precision": prec, "recall": rec, "f1": f1,
+        **{f"ft_{name}": value for name, value in fine_tune.items()},
+    }
+
+
+# --- Cross validation over the folds (stages) in wich the code is addestred ---
+# The folds run in `workers` processes, each one with max(1, cpu count // workers) TensorFlow threads
+# The fine tuning sessions are featurized here, before the workers start, and the cache is closed: the workers get
+# the feature vectors in shared memory and never open the feature cache
+def run_crossval(db_path="selene-db", folds=10, workers=FOLD_WORKERS, cache_dir=FEATURE_CACHE_DIR,
+                 parse_workers=PARSE_WORKERS):
+    print("Loading data...")
+    finetune_data = featurize_finetune_sessions(db_path, cache_dir=cache_dir)
+    fold_data = [load_fold_data(fold, parse_workers) for fold in range(folds)]
+    common_data = {f"ft_{name}": array for name, array in finetune_data.items()}
+
+    tf_threads = max(1, (os.cpu_count() or 1) // max(1, workers))
+    fold_results = run_folds(run_fold, fold_data, workers=workers, intra_threads=tf_threads, inter_threads=tf_threads,
+                             common_arrays=common_data)
+
+    all_accuracies = [r["accuracy"] for r in fold_results]
+    all_precisions = [r["precision"] for r in fold_results]
+    all_recalls = [r["recall"] for r in fold_results]
+    all_f1s = [r["f1"] for r in fold_results]
+    fine_tune_accuracies = [r["ft_accuracy"] for r in fold_results]
+    fine_tune_precisions = [r["ft_precision"] for r in fold_results]
+    fine_tune_recalls = [r["ft_recall"] for r in fold_results]
+    fine_tune_f1s = [r["ft_f1"] for r in fold_results]
+    fine_tune_cms = [r["ft_cm"] for r in fold_results]
+    fine_tune_reports = [r["ft_report"] for r in fold_results]
 
     '''
     all_confusion_matrices = []
@@ -475,14 +550,14 @@ if __name__ == "__main__":
     '''
 
     # Aggregated results
-    print("\n\n===== FINAL AVERAGED RESULTS OVER 10 FOLDS OF BASE MODEL =====")
+    print(f"\n\n===== FINAL AVERAGED RESULTS OVER {folds} FOLDS OF BASE MODEL =====")
     print(f"Mean Accuracy : {np.mean(all_accuracies):.4f} ± {np.std(all_accuracies):.4f}")
     print(f"Mean Precision: {np.mean(all_precisions):.4f} ± {np.std(all_precisions):.4f}")
     print(f"Mean Recall   : {np.mean(all_recalls):.4f} ± {np.std(all_recalls):.4f}")
     print(f"Mean F1-Score : {np.mean(all_f1s):.4f} ± {np.std(all_f1s):.4f}")
 
-    print("\n===== FINE TUNING RESULTS OVER 10 FOLDS =====")
-    for i in range(10):
+    print(f"\n===== FINE TUNING RESULTS OVER {folds} FOLDS =====")
+    for i in range(folds):
         print(f"\n--- FOLD {i} ---")
         print("Confusion Matrix:")
         cm = fine_tune_cms[i]
@@ -496,4 +571,10 @@ if __name__ == "__main__":
     print(f"Mean Accuracy : {np.mean(fine_tune_accuracies):.4f} ± {np.std(fine_tune_accuracies):.4f}")
     print(f"Mean Precision: {np.mean(fine_tune_precisions):.4f} ± {np.std(fine_tune_precisions):.4f}")
     print(f"Mean Recall   : {np.mean(fine_tune_recalls):.4f} ± {np.std(fine_tune_recalls):.4f}")
-    print(f"Mean F1-Score : {np.mean(fine_tune_f1s):.4f} ± {np.std(fine_tune_f1s):.4f}")
\ No newline at end of file
+    print(f"Mean F1-Score : {np.mean(fine_tune_f1s):.4f} ± {np.std(fine_tune_f1s):.4f}")
+
+    return fold_results
+
+
+if __name__ == "__main__":
+    run_crossval()
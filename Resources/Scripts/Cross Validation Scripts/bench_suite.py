@@ -0,0 +1,266 @@
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+
+# Benchmarks of the signal processing and model hot paths, on synthetic 6 channel 500 Hz EEG.
+#
+# Every case runs one function over the data of a size:
+#   1x16000    one block of 16000 samples (32 s), as the app processes them
+#   100x16000  100 such blocks
+#   1h         one hour of continuous signal (1800000 samples)
+# and reports, over the repeated runs (median):
+#   seconds_per_block   time for 16000 samples of the 6 channels (for 1h, the time of the whole hour / 112.5)
+#   samples_per_second  6 channel samples processed per second
+#   peak_bytes          peak of the Python and NumPy allocations during one run (tracemalloc); the memory allocated
+#                       inside TensorFlow is not seen by tracemalloc
+# The model cases (SeleneModel.train and predict) use one feature vector for each block of 16000 samples.
+#
+# Results are saved as a JSON baseline; compare_results flags every case that got slower than the baseline by
+# more than a threshold. Times are only comparable between runs on the same machine.
+
+SAMPLING_RATE = 500
+BLOCK_SIZE = 16000
+N_CHANNELS = 6
+SIZES = {
+    "1x16000": (1, BLOCK_SIZE),
+    "100x16000": (100, BLOCK_SIZE),
+    "1h": (1, SAMPLING_RATE * 3600),
+}
+DEFAULT_REPEAT = 5
+MAX_CASE_SECONDS = 20.0  # no more repetitions of a case once its runs took this long
+DEFAULT_THRESHOLD = 0.10  # 10% slower than the baseline is a regression
+
+
+# Deterministic EEG-like signal in microvolts: alpha and beta rhythms, 50 Hz line noise and white noise
+def synthetic_eeg(n_blocks, n_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_samples) / SAMPLING_RATE
+    data = rng.normal(0.0, 5.0, size=(n_blocks, N_CHANNELS, n_samples))
+    for freq, amplitude in ((10.0, 20.0), (20.0, 8.0), (50.0, 15.0)):
+        phases = rng.uniform(0, 2 * np.pi, size=(n_blocks, N_CHANNELS, 1))
+        data += amplitude * np.sin(2 * np.pi * freq * t + phases)
+    return data
+
+
+# --- Cases: each one takes the (n_blocks, 6, n_samples) data and returns a function that runs the benchmark once ---
+
+def _per_channel(function):
+    def setup(data):
+        def run():
+            for block in data:
+                for channel in block:
+                    function(channel)
+        return run
+    return setup
+
+
+def _per_block(function):
+    def setup(data):
+        def run():
+            for block in data:
+                function(block)
+        return run
+    return setup
+
+
+def _setup_preprocess_blocks(data):
+    from eeg_preprocessing import preprocess_blocks
+    return lambda: preprocess_blocks(data)
+
+
+def _setup_extract_features_batch(data):
+    from featureExPy import EegFeatureExtractor
+    return lambda: EegFeatureExtractor.extract_features_batch(data, SAMPLING_RATE)
+
+
+# Feature vectors of the blocks of 16000 samples of the data, the input of the model cases
+def _model_inputs(data):
+    from featureExPy import EegFeatureExtractor
+
+    n_windows = data.shape[2] // BLOCK_SIZE
+    blocks = data[:, :, :n_windows * BLOCK_SIZE].reshape(data.shape[0], N_CHANNELS, n_windows, BLOCK_SIZE)
+    blocks = blocks.transpose(0, 2, 1, 3).reshape(-1, N_CHANNELS, BLOCK_SIZE)
+    x = EegFeatureExtractor.extract_features_batch(blocks, SAMPLING_RATE).reshape(len(blocks), -1)
+    y = np.eye(4, dtype=np.float32)[np.arange(len(blocks)) % 4]
+    return x.astype(np.float32), y
+
+
+def _setup_train(data):
+    from addest import SeleneModel
+
+    x, y = _model_inputs(data)
+    model = SeleneModel()
+
+    def run():
+        for i in range(len(x)):
+            model.train(x[i:i + 1], y[i:i + 1])
+    return run
+
+
+def _setup_predict(data):
+    from addest import SeleneModel
+
+    x, _ = _model_inputs(data)
+    model = SeleneModel()
+    return lambda: model.predict(x)["output"].numpy()
+
+
+def _feature_case(name):
+    def setup(data):
+        from featureExPy import EegFeatureExtractor
+        function = getattr(EegFeatureExtractor, name)
+        if name == "butterworth_lowpass_filter":
+            return _per_channel(lambda s: function(s, 50.0, SAMPLING_RATE))(data)
+        if name == "extract_features_matrix":
+            return _per_block(lambda b: function(b, SAMPLING_RATE))(data)
+        return _per_channel(lambda s: function(s, SAMPLING_RATE))(data)
+    return setup
+
+
+def _setup_preprocess_matrix(data):
+    from eeg_preprocessing import preprocess_matrix
+    return _per_block(preprocess_matrix)(data)
+
+
+# Workload timeline of every block: windows of 8.5 s (not a multiple of the segment step) every 2 s
+TIMELINE_WINDOW = 4250
+TIMELINE_HOP = 1000
+STREAM_CHUNK = 500  # samples pushed at a time to SlidingWelch, one second as the app receives them
+
+
+def _setup_sliding_welch_psd(data):
+    from welch_psd import sliding_welch_psd
+    return _per_block(lambda b: sliding_welch_psd(b, SAMPLING_RATE, TIMELINE_WINDOW, TIMELINE_HOP))(data)
+
+
+# The streamed windows must be the ones of sliding_welch_psd: a different count fails the case
+def _setup_sliding_welch_stream(data):
+    from welch_psd import SlidingWelch, sliding_window_count
+
+    def run():
+        for block in data:
+            stream = SlidingWelch(SAMPLING_RATE, TIMELINE_WINDOW, TIMELINE_HOP)
+            for start in range(0, block.shape[-1], STREAM_CHUNK):
+                stream.push(block[:, start:start + STREAM_CHUNK])
+            expected = sliding_window_count(block.shape[-1], TIMELINE_WINDOW, TIMELINE_HOP)
+            if stream.windows != expected:
+                raise RuntimeError(f"SlidingWelch returned {stream.windows} windows, sliding_welch_psd {expected}")
+    return run
+
+
+CASES = {
+    "preprocess_matrix": _setup_preprocess_matrix,
+    "preprocess_blocks": _setup_preprocess_blocks,
+    "butterworth_lowpass_filter": _feature_case("butterworth_lowpass_filter"),
+    "fast_notch_50hz": _feature_case("fast_notch_50hz"),
+    "compute_welch_psd": _feature_case("compute_welch_psd"),
+    "sliding_welch_psd": _setup_sliding_welch_psd,
+    "SlidingWelch": _setup_sliding_welch_stream,
+    "extract_features_matrix": _feature_case("extract_features_matrix"),
+    "extract_features_batch": _setup_extract_features_batch,
+    "SeleneModel.train": _setup_train,
+    "SeleneModel.predict": _setup_predict,
+}
+
+
+def run_case(case, data, repeat=DEFAULT_REPEAT, max_seconds=MAX_CASE_SECONDS):
+    run = CASES[case](data)
+    run()  # warm up (caches, tf.function tracing)
+
+    times = []
+    while len(times) < repeat and sum(times) < max_seconds:
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    # Memory is measured on a separate run, tracemalloc slows down the allocations
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    seconds = float(np.median(times))
+    samples = data.shape[0] * data.shape[2]
+    return {
+        "seconds_per_block": seconds * BLOCK_SIZE / samples,
+        "samples_per_second": samples / seconds,
+        "peak_bytes": int(peak),
+        "runs": len(times),
+        "median_seconds": seconds,
+        "min_seconds": float(min(times)),
+    }
+
+
+def run_suite(cases=None, sizes=None, repeat=DEFAULT_REPEAT, max_seconds=MAX_CASE_SECONDS, seed=0):
+    cases = list(CASES) if cases is None else cases
+    sizes = list(SIZES) if sizes is None else sizes
+    unknown = [case for case in cases if case not in CASES]
+    if unknown:
+        raise ValueError(f"Unknown benchmark cases: {', '.join(unknown)} (available: {', '.join(CASES)})")
+    results = {}
+    for size in sizes:
+        data = synthetic_eeg(*SIZES[size], seed=seed)
+        for case in cases:
+            result = run_case(case, data, repeat, max_seconds)
+            results[f"{case}/{size}"] = result
+            print(f"{case + '/' + size:<40}{result['seconds_per_block'] * 1e3:>12.3f} ms/block"
+                  f"{result['samples_per_second']:>14.0f} samples/s{result['peak_bytes'] / 2 ** 20:>10.1f} MB")
+    return {"meta": environment_info(), "results": results}
+
+
+def environment_info():
+    import scipy
+
+    return {
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def save_results(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# Cases of current slower than baseline by more than threshold (relative, on seconds_per_block).
+# Returns a list of (case, baseline, current, change) for every case in both, and the list of regressed cases
+def compare_results(baseline, current, threshold=DEFAULT_THRESHOLD):
+    rows, regressions = [], []
+    for case, result in current["results"].items():
+        if case not in baseline["results"]:
+            continue
+        before = baseline["results"][case]["seconds_per_block"]
+        after = result["seconds_per_block"]
+        change = after / before - 1.0
+        rows.append((case, before, after, change))
+        if change > threshold:
+            regressions.append(case)
+    return rows, regressions
+
+
+def print_comparison(rows, regressions, threshold=DEFAULT_THRESHOLD):
+    print(f"{'case':<40}{'baseline ms':>14}{'current ms':>14}{'change':>10}")
+    for case, before, after, change in rows:
+        flag = "  REGRESSION" if case in regressions else ""
+        print(f"{case:<40}{before * 1e3:>14.3f}{after * 1e3:>14.3f}{change:>+10.1%}{flag}")
+    if regressions:
+        print(f"{len(regressions)} cases slower than the baseline by more than {threshold:.0%}")
+    else:
+        print(f"No regressions above {threshold:.0%}")
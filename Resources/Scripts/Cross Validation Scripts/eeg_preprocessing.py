@@ -1,7 +1,14 @@
+import time
+from collections import deque
+
 import numpy as np
 import pywt
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.signal import convolve
 
+import instrumentation
+from instrumentation import instrumented
+
 
 # Coefficients for Savitzky-Golay, the same values used in the kotlin script (127 values)
 SG_COEFFS = np.array([
@@ -33,6 +40,7 @@ SG_COEFFS = np.array([
 ])
 
 
+@instrumented("savitzky_golay")
 def savitzky_golay_filter(signal):
     return convolve(signal, SG_COEFFS, mode='same')
 
@@ -41,6 +49,7 @@ def soft_threshold(data, threshold):
     return np.sign(data) * np.minimum(np.abs(data), threshold)
 
 
+@instrumented("wavelet_denoise")
 def threshold_wavelet(signal, wavelet_name="db2"):
     coeffs = pywt.wavedec(signal, wavelet_name, level=4)
     if len(coeffs) < 5:
@@ -59,5 +68,153 @@ def preprocess_channel(signal):
     return thresholded[:len(signal)]  # Trim to original size
 
 
+@instrumented("preprocess")
 def preprocess_matrix(matrix):
     return np.array([preprocess_channel(ch) for ch in matrix])
+
+
+# Batched version of preprocess_matrix: works along the last axis of an (n_blocks, n_channels, n_samples) array
+# (or any N-D array of channels), so every block is processed in a single vectorized pass
+# Direct convolution of every channel, as savitzky_golay_filter: the raw values have a large DC offset, and the
+# rounding of an FFT convolution grows with it (about 1e-9 at realistic offsets), while the direct sums give the
+# same values bit for bit. The loop runs over channels only, each np.convolve is about as fast as one FFT
+@instrumented("savitzky_golay")
+def savitzky_golay_filter_blocks(blocks):
+    blocks = np.asarray(blocks, dtype=np.float64)
+    rows = blocks.reshape(-1, blocks.shape[-1])
+    filtered = np.empty_like(rows)
+    for i, row in enumerate(rows):
+        filtered[i] = np.convolve(row, SG_COEFFS, mode='same')
+    return filtered.reshape(blocks.shape)
+
+
+@instrumented("wavelet_denoise")
+def threshold_wavelet_blocks(blocks, wavelet_name="db2", thresholds=None):
+    coeffs = pywt.wavedec(blocks, wavelet_name, level=4, axis=-1)
+    if len(coeffs) < 5:
+        raise ValueError("Insufficient wavelet components")
+
+    # One cD3 threshold for each channel of each block, unless fixed thresholds are given
+    if thresholds is None:
+        t = np.std(coeffs[2], axis=-1, keepdims=True) * 0.8
+    else:
+        t = np.asarray(thresholds, dtype=np.float64)[..., np.newaxis]
+
+    thresholded = [soft_threshold(c, t) for c in coeffs]
+    return pywt.waverec(thresholded, wavelet_name, axis=-1)
+
+
+@instrumented("preprocess")
+def preprocess_blocks(blocks):
+    blocks = np.asarray(blocks, dtype=np.float64)
+    detrended = blocks - savitzky_golay_filter_blocks(blocks)
+    thresholded = threshold_wavelet_blocks(detrended)
+    return thresholded[..., :blocks.shape[-1]]  # Trim to original size
+
+
+# Number of samples after sample i that savitzky_golay_filter needs to compute its value (60 at 500 Hz, 0.12 s)
+SG_DELAY = (len(SG_COEFFS) - 1) // 2
+# Decimation of the level 4 wavelet transform: windows must start on this grid to give the same coefficients
+WAVELET_STRIDE = 2 ** 4
+
+
+# Streaming version of preprocess_matrix for live data, fed with chunks of any size of shape (n_channels, k).
+# - The Savitzky-Golay stage keeps the last len(SG_COEFFS) - 1 raw samples of each channel and gives the detrended
+#   values of savitzky_golay_filter SG_DELAY samples later, with the same direct convolution: bit for bit, but for
+#   the first and last SG_DELAY samples of a session, where the zeros of the buffers are part of the sums and
+#   change their rounding (differences of about 1e-16 relative to the signal).
+# - The wavelet stage keeps the last `window` detrended samples of each channel. Every `hop` samples it
+#   denoises the whole window and keeps only its central `hop` samples, so each output sample has
+#   about (window - hop) // 2 samples of context on both sides. Windows start on the WAVELET_STRIDE grid, so
+#   the cD3 threshold is the only difference from preprocess_channel: it is computed on each window instead
+#   of on the whole block, unless fixed per-channel `thresholds` are given (e.g. from a calibration block).
+# The output stream is the input stream delayed by exactly `delay` samples: after n samples have been pushed,
+# n - delay samples in total have been returned (about 2.7 s with the default values at 500 Hz).
+# The first and last window of a session use zero padding instead of the symmetric extension of pywt, so
+# samples near the edges differ from preprocess_channel.
+# Memory is bounded by window + hop + len(SG_COEFFS) samples per channel, whatever the session length.
+# With the instrumentation enabled, every push that releases samples records "stream_arrival_to_output", the time
+# since the arrival of the oldest released sample, and sets last_output_arrival (perf_counter time of that
+# arrival), so the caller can also record the latency from the arrival of a sample to its prediction.
+class StreamingPreprocessor:
+
+    def __init__(self, n_channels=6, window=2048, hop=512, wavelet_name="db2", thresholds=None):
+        if hop <= 0 or hop > window:
+            raise ValueError(f"hop must be in (0, window], got hop={hop} window={window}")
+        if hop % WAVELET_STRIDE != 0:
+            raise ValueError(f"hop must be a multiple of {WAVELET_STRIDE}, got {hop}")
+
+        self.n_channels = n_channels
+        self.window = window
+        self.hop = hop
+        self.wavelet_name = wavelet_name
+        self.thresholds = None if thresholds is None else np.asarray(thresholds, dtype=np.float64).reshape(n_channels)
+
+        self.left_margin = (window - hop) // 2 // WAVELET_STRIDE * WAVELET_STRIDE
+        self.right_margin = window - hop - self.left_margin
+        self.delay = SG_DELAY + self.right_margin + hop - 1
+        self.reset()
+
+    def reset(self):
+        # Leading zeros mirror the zero padding of convolve(mode='same') at the start of a block
+        self._sg_buf = np.zeros((self.n_channels, len(SG_COEFFS) - 1 - SG_DELAY))
+        self._wt_buf = np.zeros((self.n_channels, self.left_margin))
+        self._out_buf = np.zeros((self.n_channels, 0))
+        self._pushed = 0
+        self._emitted = 0
+        self._arrivals = deque()  # (samples pushed at the end of a chunk, arrival time), only when instrumented
+        self.last_output_arrival = None
+
+    @instrumented("stream_preprocess", bytes_arg=1)
+    def push(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if chunk.ndim == 1 and self.n_channels == 1:
+            chunk = chunk[np.newaxis, :]
+        if chunk.ndim != 2 or chunk.shape[0] != self.n_channels:
+            raise ValueError(f"Expected a chunk of shape ({self.n_channels}, k), got {chunk.shape}")
+        self._pushed += chunk.shape[1]
+        if instrumentation.is_enabled():
+            self._arrivals.append((self._pushed, time.perf_counter()))
+
+        # Savitzky-Golay detrend ('valid' convolution over the kept raw samples plus the new chunk)
+        taps = len(SG_COEFFS)
+        sg_buf = np.concatenate([self._sg_buf, chunk], axis=1)
+        if sg_buf.shape[1] >= taps:
+            # Direct convolution as savitzky_golay_filter_blocks: an FFT would differ in the last bits
+            trend = np.stack([np.convolve(row, SG_COEFFS, mode='valid') for row in sg_buf])
+            start = taps - 1 - SG_DELAY
+            detrended = sg_buf[:, start:start + trend.shape[1]] - trend
+            sg_buf = sg_buf[:, -(taps - 1):]
+        else:
+            detrended = np.zeros((self.n_channels, 0))
+        self._sg_buf = sg_buf.copy()
+
+        # Wavelet denoise of every complete window, all windows and channels in a single batch
+        wt_buf = np.concatenate([self._wt_buf, detrended], axis=1)
+        if wt_buf.shape[1] >= self.window:
+            n_windows = (wt_buf.shape[1] - self.window) // self.hop + 1
+            windows = sliding_window_view(wt_buf, self.window, axis=-1)[:, ::self.hop][:, :n_windows]
+            denoised = threshold_wavelet_blocks(windows.transpose(1, 0, 2), self.wavelet_name, self.thresholds)
+            central = denoised[:, :, self.left_margin:self.left_margin + self.hop]
+            central = central.transpose(1, 0, 2).reshape(self.n_channels, n_windows * self.hop)
+            self._out_buf = np.concatenate([self._out_buf, central], axis=1)
+            wt_buf = wt_buf[:, n_windows * self.hop:]
+        self._wt_buf = wt_buf.copy()
+
+        # Release only the samples allowed by the fixed delay
+        ready = max(0, self._pushed - self.delay) - self._emitted
+        output = self._out_buf[:, :ready]
+        self._out_buf = self._out_buf[:, ready:].copy()
+        if ready > 0 and instrumentation.is_enabled():
+            # Arrival of the chunk that contained the oldest released sample
+            while self._arrivals and self._arrivals[0][0] <= self._emitted:
+                self._arrivals.popleft()
+            if self._arrivals:
+                self.last_output_arrival = self._arrivals[0][1]
+                instrumentation.record("stream_arrival_to_output", time.perf_counter() - self.last_output_arrival)
+        self._emitted += ready
+        return output
+
+    def flush(self):
+        # Zeros at the end mirror the zero padding of convolve(mode='same'), and release the last samples
+        return self.push(np.zeros((self.n_channels, self.delay)))
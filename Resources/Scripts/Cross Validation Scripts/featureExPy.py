@@ -2,6 +2,9 @@ import numpy as np
 from scipy.fft import fft
 from numpy import log as ln
 from math import cos, pi, sqrt, tan, sin
+import welch_psd
+from iir_filter import BiquadFilter, lowpass_decimate
+from instrumentation import instrumented
 
 # Python translation of EegFeatureExtractor.kt
 class EegFeatureExtractor:
@@ -51,15 +54,19 @@ class EegFeatureExtractor:
         return -np.sum(norm_psd * ln(norm_psd))
 
     @staticmethod
-    def extract_features_matrix(preprocessed_channels, sampling_rate):
+    @instrumented("extract_features")
+    def extract_features_matrix(preprocessed_channels, sampling_rate, parity=False):
 
         # In this python evaluation scripts, preprocessing is performed in addest.py before the use of this function
         features_matrix = []
 
+        # Subsempling of all channels together, computing only the kept samples of the lowpass filter
+        # (parity=True gives the same values of butterworth_lowpass_filter + subsample, as in the kotlin code)
+        subsampled_channels = lowpass_decimate(preprocessed_channels, 5, cutoff_freq=50.0,
+                                               sampling_rate=sampling_rate, parity=parity)
+
         for ch_idx, signal in enumerate(preprocessed_channels):
-            # Subsempling
-            low_filtered_signal = EegFeatureExtractor.butterworth_lowpass_filter(signal, cutoff_freq=50.0, sampling_rate=sampling_rate)
-            subsampled_signal = EegFeatureExtractor.subsample(low_filtered_signal, factor=5)
+            subsampled_signal = subsampled_channels[ch_idx]
             notch_filtered_signal = EegFeatureExtractor.fast_notch_50hz(subsampled_signal, sampling_rate // 5)
 
             freqs, psd = EegFeatureExtractor.compute_welch_psd(notch_filtered_signal, sampling_rate // 5)
@@ -100,45 +107,88 @@ class EegFeatureExtractor:
 
         return np.array(features_matrix, dtype=np.float32)
 
+    # Batched version of extract_features_matrix: blocks has shape (n_blocks, n_channels, n_samples) and the result
+    # has shape (n_blocks, n_channels, 15), with the features in the same order (SELECTED_FEATURES in addest.py).
+    # Mean, sum of squares, max, total PSD and band masks are computed once, and every reduction runs over all
+    # channels of all blocks together. parity=True uses the exact filters of the kotlin code, as in
+    # extract_features_matrix; otherwise the fused lowpass and the lfilter notch are used.
+    @staticmethod
+    @instrumented("extract_features")
+    def extract_features_batch(blocks, sampling_rate, parity=False):
+        blocks = np.asarray(blocks, dtype=np.float64)
+        if blocks.ndim != 3:
+            raise ValueError(f"Expected blocks of shape (n_blocks, n_channels, n_samples), got {blocks.shape}")
+        n = blocks.shape[-1]
+
+        # Filters and PSD of every channel of every block
+        subsampled = lowpass_decimate(blocks, 5, cutoff_freq=50.0, sampling_rate=sampling_rate, parity=parity)
+        notch_filtered = BiquadFilter.notch_50hz(sampling_rate // 5, parity=parity).filter(subsampled)
+        freqs, psd = EegFeatureExtractor.compute_welch_psd(notch_filtered, sampling_rate // 5)
+
+        # Shared intermediates
+        mean = np.mean(blocks, axis=-1)
+        sum_sq = np.sum(np.square(blocks), axis=-1)
+        max_val = np.max(blocks, axis=-1)
+        total_psd = np.sum(psd, axis=-1)
+
+        def band(low, high):
+            return np.sum(psd[..., np.logical_and(freqs >= low, freqs <= high)], axis=-1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            abs_delta = band(0.5, 4.0)
+            abs_theta = band(4.0, 8.0)
+            abs_alpha = band(8.0, 13.0)
+            abs_beta = band(13.0, 30.0)
+            rel_delta = abs_delta / total_psd
+            rel_theta = abs_theta / total_psd
+            rel_alpha = abs_alpha / total_psd
+
+            theta_alpha_to_beta = np.where(abs_beta != 0, (abs_theta + abs_alpha) / abs_beta, 0.0)
+            theta_to_alpha = np.where(abs_alpha != 0, abs_theta / abs_alpha, 0.0)
+
+            power = sum_sq / n
+            rms = np.sqrt(power)
+            variance = np.mean(np.square(blocks - mean[..., np.newaxis]), axis=-1)
+            form_factor = rms / np.abs(mean)
+            pulse_indicator = np.where(rms != 0, max_val / rms, 0.0)
+
+            norm_psd = psd / total_psd[..., np.newaxis]
+            entropy_terms = np.where(norm_psd > 0, norm_psd * ln(np.where(norm_psd > 0, norm_psd, 1.0)), 0.0)
+            spectral_entropy = np.where(total_psd != 0, -np.sum(entropy_terms, axis=-1), 0.0)
+
+        return np.stack([
+            abs_beta,
+            rms,
+            power,
+            theta_to_alpha,
+            rel_delta,
+            variance,
+            rel_theta,
+            form_factor,
+            abs_theta,
+            abs_alpha,
+            pulse_indicator,
+            spectral_entropy,
+            rel_alpha,
+            theta_alpha_to_beta,
+            abs_delta
+        ], axis=-1).astype(np.float32)
+
     @staticmethod
     def flatten_features_matrix(features_matrix):
         return features_matrix.flatten()
 
     @staticmethod
     def hamming_window(N: int) -> np.ndarray:
-        return np.array([0.54 - 0.46 * cos(2.0 * pi * i / (N - 1)) for i in range(N)])
+        return welch_psd.hamming_window(N)
 
     @staticmethod
-    def compute_welch_psd(signal: np.ndarray, sampling_rate: int):
-        segment_length = 2000  # 4 second window at 500 Hz sampling rate
-        overlap = segment_length // 2
-        step = segment_length - overlap
-
-        window = EegFeatureExtractor.hamming_window(segment_length)
-        window_power = np.sum(window ** 2) / segment_length
-
-        num_segments = (len(signal) - overlap) // step
-        psd = np.zeros(segment_length // 2 + 1, dtype=np.float64)
-
-        for i in range(num_segments):
-            start = i * step
-            segment = signal[start:start + segment_length].copy()
-
-            segment *= window
-
-            fft_result = fft(segment, n=segment_length * 2)
-
-            for j in range(segment_length // 2 + 1):
-                re = fft_result[j].real
-                im = fft_result[j].imag
-                psd[j] += (re * re + im * im) / (segment_length * sampling_rate * window_power)
-
-        psd /= num_segments
-
-        freqs = np.array([j * sampling_rate / segment_length for j in range(segment_length // 2 + 1)])
-        return freqs, psd
+    def compute_welch_psd(signal: np.ndarray, sampling_rate: int, parity: bool = True):
+        # 2000 samples segments with 50% overlap, see welch_psd.py (parity=True gives the values of the kotlin code)
+        return welch_psd.welch_psd(signal, sampling_rate, parity=parity)
 
     @staticmethod
+    @instrumented("butterworth")
     def butterworth_lowpass_filter(signal: np.ndarray, cutoff_freq: float, sampling_rate: float) -> np.ndarray:
         filtered = np.zeros_like(signal)
 
@@ -168,9 +218,10 @@ class EegFeatureExtractor:
     @staticmethod
     def subsample(signal: np.ndarray, factor: int) -> np.ndarray:
         new_size = len(signal) // factor
-        return np.array([signal[i * factor] for i in range(new_size)])
+        return signal[:new_size * factor:factor].copy()
 
     @staticmethod
+    @instrumented("notch")
     def fast_notch_50hz(signal: np.ndarray, sampling_rate: int) -> np.ndarray:
         f0 = 50.0
         Q = 30.0
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import pywt
+import scipy
+
+import eeg_preprocessing
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, a cache directory must not be shared between processes
+    fcntl = None
+
+
+# Persistent cache of the flattened feature vectors (6 channels x 15 features = 90 floats) of raw EEG blocks.
+#
+# The key of a block is the hash of its raw bytes, its shape, the sampling rate and the pipeline fingerprint, so
+# the same block always maps to the same entry and a change in the pipeline gives new keys.
+# Storage, in cache_dir:
+# - features.npy: memory-mapped float32 array of shape (max_entries, vector_len), one vector per slot
+# - index.json: fingerprint, shape of the array and the key -> slot map, from least to most recently used
+# When the cache is full the least recently used entry is overwritten. If the fingerprint, max_entries or
+# vector_len of an existing cache are different from the requested ones, the cache is emptied.
+# A cache holds a lock on cache_dir/lock while it is open: exclusive when it can write, shared with read_only=True.
+# Processes opening the same directory (cross validation workers, two runs at once) wait for the writer to close,
+# so the index is never rewritten under another process. A read-only cache never writes: misses are computed and
+# returned without being stored, and a missing or out of date cache behaves as an empty one.
+# The index on disk is rewritten only by flush and close. Before a slot the index on disk maps to a key gets another
+# vector (LRU eviction, or a key stored again), the file cache_dir/dirty is created, and flush removes it after the
+# new index is written: a process killed in between leaves it, and the cache is emptied at the next open instead of
+# returning the vectors of other blocks.
+
+# Modules whose source code is part of the fingerprint: any change in them invalidates the cached features
+PIPELINE_MODULES = ["eeg_preprocessing", "featureExPy", "iir_filter", "welch_psd", "finetune_sessions"]
+
+
+def pipeline_fingerprint(feature_names, wavelet_name="db2", wavelet_level=4):
+    h = hashlib.sha256()
+    h.update(eeg_preprocessing.SG_COEFFS.astype(np.float64).tobytes())
+    h.update(f"{wavelet_name}|{wavelet_level}|".encode())
+    h.update("|".join(feature_names).encode())
+    h.update(f"|numpy={np.__version__}|scipy={scipy.__version__}|pywt={pywt.__version__}".encode())
+
+    for module_name in PIPELINE_MODULES:
+        __import__(module_name)
+        with open(sys.modules[module_name].__file__, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class FeatureCache:
+
+    def __init__(self, cache_dir, fingerprint, max_entries=100000, vector_len=90, read_only=False):
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.vector_len = vector_len
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index_path = os.path.join(cache_dir, "index.json")
+        self._data_path = os.path.join(cache_dir, "features.npy")
+        self._dirty_path = os.path.join(cache_dir, "dirty")
+        self._lock_file = open(os.path.join(cache_dir, "lock"), "a")
+        if fcntl is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_SH if read_only else fcntl.LOCK_EX)
+
+        # key -> slot, ordered from least to most recently used
+        self._entries = OrderedDict()
+        index = None
+        self._dirty = os.path.exists(self._dirty_path)
+        if os.path.exists(self._index_path) and os.path.exists(self._data_path) and not self._dirty:
+            with open(self._index_path) as f:
+                index = json.load(f)
+
+        if (index is not None and index["fingerprint"] == fingerprint and index["max_entries"] == max_entries
+                and index["vector_len"] == vector_len):
+            self._data = np.load(self._data_path, mmap_mode="r" if read_only else "r+")
+            self._entries.update((key, slot) for key, slot in index["entries"])
+        elif read_only:
+            self._data = None
+        else:
+            self._data = np.lib.format.open_memmap(self._data_path, mode="w+", dtype=np.float32,
+                                                   shape=(max_entries, vector_len))
+            self.flush()
+
+        used = set(self._entries.values())
+        self._free_slots = [slot for slot in range(max_entries - 1, -1, -1) if slot not in used]
+
+    def key(self, block, sampling_rate):
+        block = np.ascontiguousarray(block, dtype=np.float64)
+        h = hashlib.sha256()
+        h.update(self.fingerprint.encode())
+        h.update(f"|{block.shape}|{sampling_rate}|".encode())
+        h.update(block.tobytes())
+        return h.hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        slot = self._entries.get(key)
+        if slot is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return np.array(self._data[slot])
+
+    def put(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if vector.shape[0] != self.vector_len:
+            raise ValueError(f"Expected a feature vector of length {self.vector_len}, got {vector.shape[0]}")
+        if self.read_only:
+            return
+
+        if key in self._entries:
+            slot = self._entries[key]
+            self._entries.move_to_end(key)
+            self._mark_dirty()
+        elif self._free_slots:
+            slot = self._free_slots.pop()
+            self._entries[key] = slot
+        else:
+            # LRU eviction: the oldest entry gives its slot to the new one
+            _, slot = self._entries.popitem(last=False)
+            self._entries[key] = slot
+            self._mark_dirty()
+        self._data[slot] = vector
+
+    # Before the first vector written in a slot of the index on disk, see above
+    def _mark_dirty(self):
+        if not self._dirty:
+            open(self._dirty_path, "w").close()
+            self._dirty = True
+
+    def get_or_compute(self, block, sampling_rate, compute):
+        key = self.key(block, sampling_rate)
+        vector = self.get(key)
+        if vector is None:
+            vector = np.asarray(compute(block, sampling_rate), dtype=np.float32).reshape(-1)
+            self.put(key, vector)
+        return vector
+
+    def flush(self):
+        if self.read_only:
+            return
+        self._data.flush()
+        index = {
+            "fingerprint": self.fingerprint,
+            "max_entries": self.max_entries,
+            "vector_len": self.vector_len,
+            "entries": list(self._entries.items()),
+        }
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self._index_path)
+        if self._dirty:
+            os.remove(self._dirty_path)
+            self._dirty = False
+
+    def close(self):
+        self.flush()
+        del self._data
+        # Closing the file releases the lock
+        self._lock_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,156 @@
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+
+# Binary columnar store of the feature matrices of a dataset split (train, validation or test folder).
+#
+# Reading hundreds of .xlsx files with openpyxl just to get a 6x15 table each is far slower than training, so
+# each split is compiled once into .npy files next to the split folder:
+#   <stage>/.feature_store/<split>_features.npy   float64 (n_files, INPUT_ROWS * len(SELECTED_FEATURES))
+#   <stage>/.feature_store/<split>_labels.npy     labels from <split>_labels.csv
+#   <stage>/.feature_store/<split>_files.npy      name of the .xlsx file of each row
+#   <stage>/.feature_store/<split>_manifest.json  signature of the sources used to build the files above
+# The features are read back with memory mapping. The signature contains name, size and modification time of
+# every .xlsx file and of the labels file, together with the selected features: when any of them changes, the
+# split is compiled again the next time it is loaded.
+
+STORE_DIR_NAME = ".feature_store"
+# Processes used to parse the .xlsx files when a split is compiled: parallel parsing is opt-in, as the callers import
+# TensorFlow before loading the splits. Workers are spawned, never forked, as in fold_runner.py
+DEFAULT_WORKERS = 1
+
+
+def read_labels(labels_file):
+    import pandas as pd
+
+    labels_df = pd.read_csv(labels_file, skiprows=1, header=None, names=["file", "label"])
+    return dict(zip(labels_df["file"], labels_df["label"]))
+
+
+def read_feature_file(file_path, selected_features, input_rows):
+    import pandas as pd
+
+    df_full = pd.read_excel(file_path, engine='openpyxl')
+
+    # Taking only the SELECTED_FEATURES (that matrix has 29 feature, we use only the best 15)
+    selected_cols = [col for col in df_full.columns if col in selected_features]
+
+    # Line from 2 to 7 (this function starts count from 0, excel from 1)
+    df_selected = df_full.loc[0:, selected_cols]
+
+    data_array = df_selected.values
+    if data_array.shape != (input_rows, len(selected_features)):
+        raise ValueError(f"{os.path.basename(file_path)} shape mismatch: {data_array.shape}")
+    return data_array.flatten()
+
+
+# Wrapper of read_feature_file for the worker processes: errors are returned, so they can all be reported together
+def _read_feature_file_or_error(args):
+    file_path, selected_features, input_rows = args
+    try:
+        return read_feature_file(file_path, selected_features, input_rows), None
+    except ValueError as e:
+        return None, str(e)
+    except Exception as e:
+        return None, f"{os.path.basename(file_path)}: {e}"
+
+
+# Parsing of all the .xlsx files of a split, in the same way of load_data_from_folder.
+# With workers > 1 the files are parsed by a pool of spawned processes; rows always follow the sorted file names.
+# Unlabeled files are skipped and listed in a single message, malformed files (shape different from
+# (input_rows, len(selected_features)) or unreadable) are all listed in a single ValueError.
+def parse_feature_folder(folder_path, labels_file, selected_features, input_rows, workers=DEFAULT_WORKERS):
+    from tqdm import tqdm
+
+    label_dict = read_labels(labels_file)
+    file_names = sorted(f for f in os.listdir(folder_path) if f.endswith('.xlsx'))
+
+    unlabeled = [f for f in file_names if f not in label_dict]
+    names = [f for f in file_names if f in label_dict]
+    tasks = [(os.path.join(folder_path, f), list(selected_features), input_rows) for f in names]
+
+    if workers > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        chunksize = max(1, len(tasks) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results = list(tqdm(executor.map(_read_feature_file_or_error, tasks, chunksize=chunksize),
+                                total=len(tasks), desc=f"Loading {folder_path} data ({workers} workers)"))
+    else:
+        results = [_read_feature_file_or_error(task) for task in tqdm(tasks, desc=f"Loading {folder_path} data")]
+
+    if unlabeled:
+        print(f"{len(unlabeled)} files skipped (no label): {', '.join(unlabeled)}")
+    errors = [error for _, error in results if error is not None]
+    if errors:
+        raise ValueError(f"{len(errors)} malformed files in {folder_path}:\n" + "\n".join(errors))
+
+    X = np.array([data for data, _ in results])
+    y = np.array([label_dict[f] for f in names])
+    return X, y, np.array(names)
+
+
+def source_signature(folder_path, labels_file, selected_features, input_rows):
+    def file_stat(path):
+        st = os.stat(path)
+        return [os.path.basename(path), st.st_size, st.st_mtime_ns]
+
+    file_names = sorted(f for f in os.listdir(folder_path) if f.endswith('.xlsx'))
+    return {
+        "selected_features": list(selected_features),
+        "input_rows": input_rows,
+        "labels": file_stat(labels_file),
+        "files": [file_stat(os.path.join(folder_path, f)) for f in file_names],
+    }
+
+
+def store_paths(folder_path):
+    folder_path = os.path.normpath(folder_path)
+    store_dir = os.path.join(os.path.dirname(folder_path), STORE_DIR_NAME)
+    split = os.path.basename(folder_path)
+    return store_dir, {
+        "features": os.path.join(store_dir, f"{split}_features.npy"),
+        "labels": os.path.join(store_dir, f"{split}_labels.npy"),
+        "files": os.path.join(store_dir, f"{split}_files.npy"),
+        "manifest": os.path.join(store_dir, f"{split}_manifest.json"),
+    }
+
+
+def compile_split(folder_path, labels_file, selected_features, input_rows, workers=DEFAULT_WORKERS):
+    store_dir, paths = store_paths(folder_path)
+    os.makedirs(store_dir, exist_ok=True)
+
+    signature = source_signature(folder_path, labels_file, selected_features, input_rows)
+    X, y, names = parse_feature_folder(folder_path, labels_file, selected_features, input_rows, workers)
+    if len(X) == 0:
+        X = np.zeros((0, input_rows * len(selected_features)))
+
+    np.save(paths["features"], X.astype(np.float64))
+    np.save(paths["labels"], y)
+    np.save(paths["files"], names)
+    # The manifest is written last, so an interrupted compilation is done again at the next load
+    tmp_path = paths["manifest"] + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(signature, f)
+    os.replace(tmp_path, paths["manifest"])
+
+
+# Features, labels and file names of a split, compiling the store first if it is missing or out of date
+def load_split(folder_path, labels_file, selected_features, input_rows, workers=DEFAULT_WORKERS):
+    _, paths = store_paths(folder_path)
+
+    up_to_date = False
+    if os.path.exists(paths["manifest"]):
+        with open(paths["manifest"]) as f:
+            up_to_date = json.load(f) == source_signature(folder_path, labels_file, selected_features, input_rows)
+    if not up_to_date:
+        print(f"Compiling feature store for {folder_path}...")
+        compile_split(folder_path, labels_file, selected_features, input_rows, workers)
+
+    X = np.load(paths["features"], mmap_mode='r')
+    y = np.load(paths["labels"])
+    names = np.load(paths["files"])
+    return X, y, names
@@ -0,0 +1,131 @@
+import random
+import sqlite3
+from collections import defaultdict
+
+import numpy as np
+
+from eeg_preprocessing import preprocess_matrix
+from feature_cache import FeatureCache, pipeline_fingerprint
+from featureExPy import EegFeatureExtractor
+from instrumentation import instrumented
+from session_reader import ensure_session_index, read_session_blocks, read_session_labels, read_session_windows
+
+
+# Feature vectors of the EEG sessions recorded by the app (selene-db), used for fine tuning and its evaluation.
+# Nothing here needs TensorFlow or scikit-learn, so the sessions can be featurized without loading them.
+
+INPUT_ROWS = 6  # lines to use in each matrix: from 2 to 7 (6 channels, line 1 is title line, 8 is channel7 not used)
+# Selected features used in the app
+SELECTED_FEATURES = [
+    "Abs_beta_Power", "RMS", "POWER", "Theta_to_Alpha_Ratio", "Rel_delta_Power", "VAR",
+    "Rel_theta_Power", "FORM FACTOR", "Abs_theta_Power", "Abs_alpha_Power", "PULSE INDICATOR",
+    "Spectral_Entropy", "Rel_alpha_Power", "Theta_Alpha_to_Beta_Ratio", "Abs_delta_Power"
+]
+
+
+def balanced_session_split(cursor, num_classes=4, total_test_sessions=14, session_labels=None, rng=None):
+    # Labels of all sessions with a single query (see session_reader.py), unless already read by the caller
+    if session_labels is None:
+        session_labels = read_session_labels(cursor)
+    # random.Random(seed) for a reproducible split
+    if rng is None:
+        rng = random
+
+    class_to_sessions = defaultdict(list)
+    for session_id, tiredness in session_labels.items():
+        if tiredness < num_classes:
+            class_to_sessions[tiredness].append(session_id)
+
+    test_sessions = []
+    train_sessions = []
+
+    for tiredness in range(num_classes):
+        sessions = class_to_sessions[tiredness]
+        if len(sessions) < 2:
+            raise ValueError(f"Classe {tiredness} ha meno di 2 sessioni disponibili.")
+        selected_test = rng.choice(sessions)
+        test_sessions.append(selected_test)
+        remaining = [s for s in sessions if s != selected_test]
+        train_sessions.extend(remaining)
+
+    remaining_test_needed = total_test_sessions - num_classes
+    if remaining_test_needed > 0:
+        extra_test = rng.sample(train_sessions, remaining_test_needed)
+        for s in extra_test:
+            train_sessions.remove(s)
+        test_sessions.extend(extra_test)
+
+    return train_sessions, test_sessions
+
+# Preprocessing and features extraction of one (6, N) raw block, as done in the app
+def featurize_block(block, sampling_rate=500):
+    # Preprocessing using Savitzky-Golay filter and Wavelet trasform
+    block = preprocess_matrix(block)
+    # Features extraction
+    features_matrix = EegFeatureExtractor.extract_features_matrix(block, sampling_rate)
+    return EegFeatureExtractor.flatten_features_matrix(features_matrix)
+
+
+#For the test, in selene-db, 34 16000-samples sessions were created
+# Feature vectors of all the sessions of the db, computed once and then split many times with split_finetune_data:
+#   "X", "y", "sessions": feature vector, label and session of every block
+#   "label_sessions", "label_values": label of every session in the db, used for the split
+# With cache_dir, the feature vectors are stored on disk and reused while blocks and pipeline do not change
+# With hop, every session is streamed from the db and all its windows of block_size samples (moving by hop samples)
+# are used, each one as a separate feature vector with the label of its session; otherwise only the first block is used
+@instrumented("featurize")
+def featurize_finetune_sessions(db_path, block_size=16000, cache_dir=None, hop=None):
+    x_all, y_all, sessions = [], [], []
+
+    cache = None
+    if cache_dir is not None:
+        cache = FeatureCache(cache_dir, pipeline_fingerprint(SELECTED_FEATURES),
+                             vector_len=INPUT_ROWS * len(SELECTED_FEATURES))
+
+    # The reads use an index on (session_id, timestamp), created on a copy of the db if it is missing
+    conn = sqlite3.connect(ensure_session_index(db_path))
+    cursor = conn.cursor()
+    session_labels = read_session_labels(cursor)
+
+    # Sessions shorter than block_size are skipped, block shape is (6, 16000)
+    if hop is None:
+        blocks = read_session_blocks(cursor, block_size, session_labels)
+    else:
+        blocks = ((session_id, tiredness, block) for session_id, tiredness, _, block
+                  in read_session_windows(cursor, block_size, hop, session_labels))
+
+    for session_id, tiredness, block in blocks:
+        if cache is not None:
+            flat_vector = cache.get_or_compute(block, 500, featurize_block)
+        else:
+            flat_vector = featurize_block(block, 500)
+
+        x_all.append(flat_vector)
+        y_all.append(tiredness)
+        sessions.append(session_id)
+
+    conn.close()
+    if cache is not None:
+        print(f"Feature cache: {cache.hits} hits, {cache.misses} misses")
+        cache.close()
+    return {
+        "X": np.array(x_all, dtype=np.float32).reshape(-1, INPUT_ROWS * len(SELECTED_FEATURES)),
+        "y": np.array(y_all, dtype=np.int64),
+        "sessions": np.array(sessions, dtype=np.int64),
+        "label_sessions": np.array(list(session_labels.keys()), dtype=np.int64),
+        "label_values": np.array(list(session_labels.values()), dtype=np.int64),
+    }
+
+
+# Fine tuning and test sets from the output of featurize_finetune_sessions, splitting by session
+# (balanced_session_split guarantees at least one session for each label in train and test sets)
+def split_finetune_data(finetune_data, seed=None, total_test_sessions=14):
+    session_labels = dict(zip(finetune_data["label_sessions"].tolist(), finetune_data["label_values"].tolist()))
+    rng = random.Random(seed) if seed is not None else None
+    training_sessions, testing_sessions = balanced_session_split(
+        None, total_test_sessions=total_test_sessions, session_labels=session_labels, rng=rng)
+
+    train_mask = np.isin(finetune_data["sessions"], training_sessions)
+    test_mask = np.isin(finetune_data["sessions"], testing_sessions)
+    return (finetune_data["X"][train_mask], finetune_data["y"][train_mask],
+            finetune_data["X"][test_mask], finetune_data["y"][test_mask])
@@ -0,0 +1,97 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import instrumentation
+
+
+# Runs the cross validation folds in separate worker processes.
+#
+# The arrays of every fold (dict name -> array) are copied once into shared memory blocks by the parent; workers
+# attach to them and get read-only numpy views, so no dataset is pickled to the workers. common_arrays, the arrays
+# that are the same for all the folds (e.g. the fine tuning sessions), are copied in blocks of their own only once
+# and added to the arrays of every fold. Every worker pins the
+# TensorFlow intra-op and inter-op thread pools, so that `workers` folds running together do not oversubscribe
+# the cores. Workers are started with "spawn": a fork of a process that already imported TensorFlow is not safe.
+# Spawned workers share the resource tracker of the parent, which unlinks the blocks when all folds are done.
+# fold_fn(fold, arrays) must be a top-level function (it is pickled by reference) and its result must be picklable;
+# results are returned in fold order. When the instrumentation is enabled, the stages timed in the workers are
+# merged into the instrumentation of this process.
+
+_worker_fn = None
+_worker_arrays = None
+_worker_blocks = None
+
+
+def share_arrays(fold_arrays):
+    blocks, specs = [], []
+    for arrays in fold_arrays:
+        fold_specs = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            blocks.append(block)
+            fold_specs[name] = (block.name, array.shape, array.dtype.str)
+        specs.append(fold_specs)
+    return blocks, specs
+
+
+def attach_arrays(specs):
+    blocks, fold_arrays = [], []
+    for fold_specs in specs:
+        arrays = {}
+        for name, (block_name, shape, dtype) in fold_specs.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            array.flags.writeable = False
+            blocks.append(block)
+            arrays[name] = array
+        fold_arrays.append(arrays)
+    return blocks, fold_arrays
+
+
+def _init_worker(fold_fn, specs, common_specs, intra_threads, inter_threads):
+    global _worker_fn, _worker_arrays, _worker_blocks
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+
+    _worker_fn = fold_fn
+    _worker_blocks, _worker_arrays = attach_arrays(specs + [common_specs])
+    common = _worker_arrays.pop()
+    for arrays in _worker_arrays:
+        arrays.update(common)
+
+
+def _run_fold(fold):
+    instrumentation.reset()
+    result = _worker_fn(fold, _worker_arrays[fold])
+    return result, instrumentation.snapshot() if instrumentation.is_enabled() else None
+
+
+def run_folds(fold_fn, fold_arrays, workers=1, intra_threads=1, inter_threads=1, common_arrays=None):
+    common_arrays = common_arrays or {}
+    if workers <= 1:
+        return [fold_fn(fold, {**arrays, **common_arrays}) for fold, arrays in enumerate(fold_arrays)]
+
+    blocks, specs = share_arrays(list(fold_arrays) + [common_arrays])
+    common_specs = specs.pop()
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(fold_arrays)),
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(fold_fn, specs, common_specs, intra_threads, inter_threads)) as executor:
+            results = []
+            for result, stats in executor.map(_run_fold, range(len(fold_arrays))):
+                if stats is not None:
+                    instrumentation.merge(stats)
+                results.append(result)
+            return results
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
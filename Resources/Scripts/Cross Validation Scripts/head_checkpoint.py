@@ -0,0 +1,124 @@
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+
+# Delta checkpoints of the trainable head of SeleneModel (hl3 and tail), for personalized models.
+#
+# After training, head, hl1 and hl2 are frozen and fine tuning only changes hl3 and tail: a personalized model is
+# the base model plus 596 floats. A head checkpoint stores only those, in one file written with a single write:
+#   header      magic "SLNH", format version, number of layers, sha256 fingerprint of the frozen backbone
+#               (shapes and float32 bytes of hl1 and hl2), number of floats
+#   layer table for every head layer: name, rows and columns of the kernel
+#   data        at a 64 byte aligned offset, float32 little endian: kernel then bias of every layer, contiguous
+# load_head maps the file in memory and returns views of the data (no copy); the fingerprint of the backbone the
+# head was trained on must match the one of the base model it is applied to, otherwise ValueError.
+
+MAGIC = b"SLNH"
+FORMAT_VERSION = 1
+HEAD_LAYERS = ["hl3", "tail"]
+BACKBONE_LAYERS = ["hl1", "hl2"]
+DATA_ALIGNMENT = 64
+
+_HEADER = struct.Struct("<4sHH32sI")  # magic, version, n_layers, fingerprint, n_floats
+_LAYER = struct.Struct("<8sII")  # name, kernel rows, kernel columns
+
+
+# (kernel, bias) of every layer in names, from a SeleneModel, its Keras model or the arrays of a .npz of
+# numpy_model.export_npz
+def _layer_weights(source, names):
+    if isinstance(source, dict) or hasattr(source, "files"):
+        return [(np.asarray(source[f"{name}/kernel"]), np.asarray(source[f"{name}/bias"])) for name in names]
+    keras_model = getattr(source, "model", source)
+    return [tuple(keras_model.get_layer(name).get_weights()) for name in names]
+
+
+def backbone_fingerprint(source):
+    h = hashlib.sha256()
+    for name, (kernel, bias) in zip(BACKBONE_LAYERS, _layer_weights(source, BACKBONE_LAYERS)):
+        kernel = np.ascontiguousarray(kernel, dtype="<f4")
+        bias = np.ascontiguousarray(bias, dtype="<f4")
+        h.update(f"{name}|{kernel.shape}|{bias.shape}|".encode())
+        h.update(kernel.tobytes())
+        h.update(bias.tobytes())
+    return h.digest()
+
+
+def _data_offset(n_layers):
+    header_size = _HEADER.size + n_layers * _LAYER.size
+    return -(-header_size // DATA_ALIGNMENT) * DATA_ALIGNMENT
+
+
+def save_head(model, path):
+    layers = _layer_weights(model, HEAD_LAYERS)
+    n_floats = sum(kernel.size + bias.size for kernel, bias in layers)
+    offset = _data_offset(len(layers))
+
+    buffer = bytearray(offset + 4 * n_floats)
+    _HEADER.pack_into(buffer, 0, MAGIC, FORMAT_VERSION, len(layers), backbone_fingerprint(model), n_floats)
+    data = np.frombuffer(buffer, dtype="<f4", count=n_floats, offset=offset)
+    position = 0
+    for i, (name, (kernel, bias)) in enumerate(zip(HEAD_LAYERS, layers)):
+        _LAYER.pack_into(buffer, _HEADER.size + i * _LAYER.size, name.encode(), *kernel.shape)
+        for array in (kernel, bias):
+            data[position:position + array.size] = array.ravel()
+            position += array.size
+
+    # Written next to the destination and renamed, so a reader never sees a partial checkpoint
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(buffer)
+    os.replace(tmp_path, path)
+
+
+# {layer name: (kernel, bias)} as read-only views of the memory mapped file, and the backbone fingerprint.
+# With expected_fingerprint (see backbone_fingerprint) a head trained on another backbone raises ValueError
+def load_head(path, expected_fingerprint=None):
+    mapped = np.memmap(path, dtype=np.uint8, mode="r")
+    if len(mapped) < _HEADER.size:
+        raise ValueError(f"{path} is not a head checkpoint: too short")
+    magic, version, n_layers, fingerprint, n_floats = _HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a head checkpoint: bad magic {magic!r}")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{path} has head checkpoint version {version}, expected {FORMAT_VERSION}")
+    offset = _data_offset(n_layers)
+    if len(mapped) != offset + 4 * n_floats:
+        raise ValueError(f"{path} is truncated: {len(mapped)} bytes, expected {offset + 4 * n_floats}")
+    if expected_fingerprint is not None and fingerprint != expected_fingerprint:
+        raise ValueError(f"{path} was trained on a different backbone (hl1, hl2) than the base model")
+
+    data = np.frombuffer(mapped, dtype="<f4", count=n_floats, offset=offset)
+    layers = {}
+    position = 0
+    for i in range(n_layers):
+        name, rows, columns = _LAYER.unpack_from(mapped, _HEADER.size + i * _LAYER.size)
+        kernel = data[position:position + rows * columns].reshape(rows, columns)
+        bias = data[position + rows * columns:position + rows * columns + columns]
+        layers[name.rstrip(b"\0").decode()] = (kernel, bias)
+        position += rows * columns + columns
+    if position != n_floats:
+        raise ValueError(f"{path}: the layer table does not match the {n_floats} floats of the data")
+    return layers, fingerprint
+
+
+# Sets hl3 and tail of model (SeleneModel or its Keras model) from a head checkpoint of the same backbone
+def apply_head(model, path):
+    layers, _ = load_head(path, backbone_fingerprint(model))
+    keras_model = getattr(model, "model", model)
+    for name in HEAD_LAYERS:
+        keras_model.get_layer(name).set_weights(list(layers[name]))
+
+
+# NumpySeleneModel of a base model .npz (numpy_model.export_npz) with the head of a checkpoint: the hl3 and tail
+# arrays of the model are the views of the mapped file
+def load_numpy_model(base_path, head_path, chunk_rows=None):
+    from numpy_model import CHUNK_ROWS, LAYER_NAMES, NumpySeleneModel
+
+    with np.load(base_path) as arrays:
+        base = {key: arrays[key] for key in arrays.files}
+    head, _ = load_head(head_path, backbone_fingerprint(base))
+    layers = [head[name] if name in head else (base[f"{name}/kernel"], base[f"{name}/bias"]) for name in LAYER_NAMES]
+    return NumpySeleneModel(layers, CHUNK_ROWS if chunk_rows is None else chunk_rows)
@@ -0,0 +1,194 @@
+import numpy as np
+from math import cos, pi, sqrt, tan, sin
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import lfilter
+
+from instrumentation import instrumented
+
+
+# Vectorized engine for the two biquads of EegFeatureExtractor (butterworth_lowpass_filter and fast_notch_50hz).
+# Signals of any shape are filtered along the last axis, so all channels of all blocks run together.
+
+
+# Same coefficients computed in EegFeatureExtractor.butterworth_lowpass_filter, as (b, a) with a[0] = 1
+def butterworth_lowpass_coeffs(cutoff_freq, sampling_rate):
+    wc = tan(pi * cutoff_freq / sampling_rate)
+
+    k1 = sqrt(2.0) * wc
+    k2 = wc * wc
+    a = k2 / (1 + k1 + k2)
+    b = 2 * a
+    c = a
+    d = 2 * (k2 - 1) / (1 + k1 + k2)
+    e = (1 - k1 + k2) / (1 + k1 + k2)
+
+    return (a, b, c), (1.0, d, e)
+
+
+# Same coefficients computed in EegFeatureExtractor.fast_notch_50hz, as (b, a) with a[0] = 1
+def notch_50hz_coeffs(sampling_rate):
+    f0 = 50.0
+    Q = 30.0
+
+    w0 = 2 * pi * f0 / sampling_rate
+    alpha = sin(w0) / (2 * Q)
+
+    b0 = 1.0
+    b1 = -2 * cos(w0)
+    b2 = 1.0
+    a0 = 1 + alpha
+    a1 = -2 * cos(w0)
+    a2 = 1 - alpha
+
+    return (b0 / a0, b1 / a0, b2 / a0), (1.0, a1 / a0, a2 / a0)
+
+
+# Direct form I biquad with the state (x1, x2, y1, y2) of every channel, so consecutive blocks can be
+# filtered one after the other as if they were a single signal.
+# - parity=True runs the same recurrence, with the same operation order, as the per-sample loops of
+#   EegFeatureExtractor (and so of the Kotlin EegFeatureExtractor): the results are bit-for-bit identical.
+#   The loop over time stays in Python, but every step updates all channels of all blocks at once.
+# - parity=False uses scipy.signal.lfilter (direct form II transposed, compiled), which differs only by
+#   floating point rounding.
+class BiquadFilter:
+
+    def __init__(self, b, a, parity=False):
+        if len(b) != 3 or len(a) != 3 or a[0] != 1.0:
+            raise ValueError("Expected biquad coefficients b = (b0, b1, b2) and a = (1, a1, a2)")
+        self.b = tuple(float(v) for v in b)
+        self.a = tuple(float(v) for v in a)
+        self.parity = parity
+        self.reset()
+
+    @classmethod
+    def butterworth_lowpass(cls, cutoff_freq, sampling_rate, parity=False):
+        return cls(*butterworth_lowpass_coeffs(cutoff_freq, sampling_rate), parity=parity)
+
+    @classmethod
+    def notch_50hz(cls, sampling_rate, parity=False):
+        return cls(*notch_50hz_coeffs(sampling_rate), parity=parity)
+
+    def reset(self):
+        # None means zero state, with the shape of the first signal that is filtered
+        self.x1 = self.x2 = self.y1 = self.y2 = None
+
+    def get_state(self):
+        return self.x1, self.x2, self.y1, self.y2
+
+    def set_state(self, x1, x2, y1, y2):
+        self.x1, self.x2, self.y1, self.y2 = (np.array(v, dtype=np.float64) for v in (x1, x2, y1, y2))
+
+    @instrumented("biquad", bytes_arg=1)
+    def filter(self, signal):
+        signal = np.asarray(signal, dtype=np.float64)
+        n = signal.shape[-1]
+        if self.x1 is None:
+            self.set_state(*(np.zeros(signal.shape[:-1]) for _ in range(4)))
+        elif self.x1.shape != signal.shape[:-1]:
+            raise ValueError(f"Filter state has shape {self.x1.shape}, signal has shape {signal.shape}")
+        if n == 0:
+            return signal.copy()
+
+        if self.parity:
+            output = self._filter_parity(signal)
+        else:
+            output = self._filter_lfilter(signal)
+
+        # The new state is given by the last two inputs and outputs (or by the old state for short signals)
+        x_hist = np.concatenate([np.stack([self.x2, self.x1], axis=-1), signal[..., -2:]], axis=-1)
+        y_hist = np.concatenate([np.stack([self.y2, self.y1], axis=-1), output[..., -2:]], axis=-1)
+        self.set_state(x_hist[..., -1], x_hist[..., -2], y_hist[..., -1], y_hist[..., -2])
+        return output
+
+    def _filter_parity(self, signal):
+        b0, b1, b2 = self.b
+        _, a1, a2 = self.a
+
+        # Time on the first axis, so every step of the recurrence works on a contiguous row of channels
+        n = signal.shape[-1]
+        x = np.ascontiguousarray(signal.reshape(-1, n).T)
+        x1 = self.x1.reshape(-1)
+        x2 = self.x2.reshape(-1)
+
+        # Feed-forward part for all samples at once, in the same order as the loop: b0*x0 + b1*x1 + b2*x2
+        y = b0 * x
+        y[0] += b1 * x1
+        y[1:] += b1 * x[:-1]
+        y[0] += b2 * x2
+        if n > 1:
+            y[1] += b2 * x1
+        y[2:] += b2 * x[:-2]
+
+        # Feedback part: (... - a1*y1) - a2*y2, one step per sample over every channel
+        tmp = np.empty_like(y[0])
+        y1, y2 = self.y1.reshape(-1), self.y2.reshape(-1)
+        for row in list(y):
+            np.multiply(a1, y1, out=tmp)
+            np.subtract(row, tmp, out=row)
+            np.multiply(a2, y2, out=tmp)
+            np.subtract(row, tmp, out=row)
+            y2 = y1
+            y1 = row
+
+        return np.ascontiguousarray(y.T).reshape(signal.shape)
+
+    def _filter_lfilter(self, signal):
+        b0, b1, b2 = self.b
+        _, a1, a2 = self.a
+
+        # Direct form I state converted to the direct form II transposed state used by lfilter
+        zi = np.stack([
+            b1 * self.x1 + b2 * self.x2 - a1 * self.y1 - a2 * self.y2,
+            b2 * self.x1 - a2 * self.y1,
+        ], axis=-1)
+        output, _ = lfilter(self.b, self.a, signal, axis=-1, zi=zi)
+        return output
+
+
+# Coefficients of the fused lowpass + decimation: the biquad b(z) / a(z) rewritten as g(z) / a_F(z^F), multiplying
+# numerator and denominator by q(z) = prod_p (1 + p z^-1 + ... + p^(F-1) z^-(F-1)) over the two poles p of a(z).
+# The poles of a_F are p^F, so the recursive part only needs one output every F samples, and the FIR part g(z)
+# (2F + 1 taps) is evaluated only at the kept samples (polyphase).
+def polyphase_biquad_coeffs(b, a, factor):
+    poles = np.roots(a)
+    q = np.array([1.0])
+    for p in poles:
+        q = np.polymul(q, p ** np.arange(factor))
+    g = np.polymul(b, q).real
+    a_f = np.poly(poles ** factor).real
+    return g, a_f
+
+
+# Butterworth lowpass (as butterworth_lowpass_filter) followed by the pick of one sample every `factor` (as
+# subsample), along the last axis of a signal of any shape. Only the kept samples are computed:
+# about (2 * factor + 1) / factor multiply-adds per input sample in the FIR part plus a biquad at the low rate.
+# - parity=False (default) is the fused polyphase stage; it differs from filter-then-pick only by floating
+#   point rounding (around 1e-13 relative to the signal amplitude for factor 5 at 500 Hz).
+# - parity=True runs the full-rate BiquadFilter in parity mode and then picks the samples, so it is bit for bit
+#   identical to subsample(butterworth_lowpass_filter(signal)) and to the kotlin code.
+@instrumented("butterworth_decimate")
+def lowpass_decimate(signal, factor, cutoff_freq, sampling_rate, parity=False):
+    signal = np.asarray(signal, dtype=np.float64)
+    factor = int(factor)
+    if factor < 1:
+        raise ValueError(f"Decimation factor must be a positive integer, got {factor}")
+    b, a = butterworth_lowpass_coeffs(cutoff_freq, sampling_rate)
+    new_size = signal.shape[-1] // factor
+
+    if parity:
+        filtered = BiquadFilter(b, a, parity=True).filter(signal)
+        return np.ascontiguousarray(filtered[..., :new_size * factor:factor])
+
+    g, a_f = polyphase_biquad_coeffs(b, a, factor)
+    if new_size == 0:
+        return np.zeros(signal.shape[:-1] + (0,))
+
+    # FIR part at the kept samples only: v[m] = sum_k g[k] x[m * factor - k], with zeros before the signal
+    taps = len(g)
+    padded = np.concatenate([np.zeros(signal.shape[:-1] + (taps - 1,)), signal[..., :(new_size - 1) * factor + 1]],
+                            axis=-1)
+    windows = sliding_window_view(padded, taps, axis=-1)[..., ::factor, :]
+    v = windows @ g[::-1]
+
+    # Recursive part at the low rate
+    return lfilter([1.0], a_f, v, axis=-1)
@@ -0,0 +1,210 @@
+import functools
+import json
+import math
+import os
+import time
+from contextlib import nullcontext
+
+
+# Opt-in timing of the pipeline stages (SQLite fetch, Savitzky-Golay, wavelet denoise, filters, Welch, feature
+# math, training steps, evaluation...).
+#
+# Stages are marked with the @instrumented(name) decorator or the stage(name) context manager. While disabled
+# (the default) the decorator only checks a flag before calling the function and stage() returns a shared
+# null context, so nothing is measured or stored. Once enabled, every stage records, under its path of nested
+# stages (e.g. "fold;featurize;preprocess;wavelet_denoise"):
+#   count, total time, self time (total minus the time of its nested stages), maximum latency, a histogram of the
+#   latencies and bytes processed (nbytes of the array argument).
+# The histogram has LATENCY_BINS_PER_DECADE log-spaced buckets per decade from 10^LATENCY_MIN_EXP to
+# 10^LATENCY_MAX_EXP seconds: its size is fixed whatever the number of calls (per-sample training steps, streaming
+# preprocessing), and the percentiles are the upper edges of their buckets, within 6% of the exact values.
+# Results are exported as JSON (summary) or as collapsed stacks with the self time in microseconds, the input
+# format of flamegraph.pl and speedscope (flame_summary).
+# enable() also sets SELENE_INSTRUMENT=1, so worker processes started afterwards (see fold_runner.py) are enabled
+# too: they send their snapshot() back and the parent merge()s it.
+
+ENV_VAR = "SELENE_INSTRUMENT"
+HISTOGRAM_EDGES = [1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, 10.0]  # seconds, upper edges of the buckets
+
+_enabled = os.environ.get(ENV_VAR) == "1"
+LATENCY_MIN_EXP = -7
+LATENCY_MAX_EXP = 3
+LATENCY_BINS_PER_DECADE = 40
+_N_BUCKETS = (LATENCY_MAX_EXP - LATENCY_MIN_EXP) * LATENCY_BINS_PER_DECADE + 2  # plus under and overflow
+
+_stats = {}  # path -> [count, total seconds, child seconds, bytes, latency buckets, recorded by record(), max seconds]
+_stack = []  # open stages: [path, seconds spent in nested stages]
+_NULL_STAGE = nullcontext()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+    os.environ[ENV_VAR] = "1"
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    os.environ.pop(ENV_VAR, None)
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    _stats.clear()
+    _stack.clear()
+
+
+# Bucket k holds the latencies in (upper edge of k - 1, upper edge of k]; the last one everything above the range
+def _bucket(seconds):
+    if seconds <= 0:
+        return 0
+    k = math.ceil((math.log10(seconds) - LATENCY_MIN_EXP) * LATENCY_BINS_PER_DECADE)
+    return min(max(k, 0), _N_BUCKETS - 1)
+
+
+def _upper_edge(k):
+    return 10.0 ** (LATENCY_MIN_EXP + k / LATENCY_BINS_PER_DECADE)
+
+
+def _entry(path, recorded):
+    entry = _stats.get(path)
+    if entry is None:
+        entry = _stats[path] = [0, 0.0, 0.0, 0, [0] * _N_BUCKETS, recorded, 0.0]
+    return entry
+
+
+def _add(path, seconds, child_seconds, nbytes, recorded=False):
+    entry = _entry(path, recorded)
+    entry[0] += 1
+    entry[1] += seconds
+    entry[2] += child_seconds
+    entry[3] += nbytes
+    entry[4][_bucket(seconds)] += 1
+    entry[6] = max(entry[6], seconds)
+
+
+class _Stage:
+
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        parent = _stack[-1][0] if _stack else None
+        self.frame = [self.name if parent is None else f"{parent};{self.name}", 0.0]
+        _stack.append(self.frame)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        _stack.pop()
+        if _stack:
+            _stack[-1][1] += seconds
+        _add(self.frame[0], seconds, self.frame[1], self.nbytes)
+        return False
+
+
+def stage(name, nbytes=0):
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, nbytes)
+
+
+# Decorator: times every call of the function as stage `name`; bytes are the nbytes of positional argument bytes_arg
+def instrumented(name, bytes_arg=0):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            nbytes = getattr(args[bytes_arg], "nbytes", 0) if len(args) > bytes_arg else 0
+            with _Stage(name, nbytes):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# A latency measured by the caller (e.g. from the arrival of a sample to its prediction). It is not time spent in
+# the open stages, so it is stored as a top level path, outside of the nesting of the stages
+def record(name, seconds, nbytes=0):
+    if not _enabled:
+        return
+    _add(name, seconds, 0.0, nbytes, recorded=True)
+
+
+def snapshot():
+    return {path: entry[:4] + [list(entry[4])] + entry[5:] for path, entry in _stats.items()}
+
+
+def merge(other):
+    for path, (count, total, child, nbytes, buckets, recorded, max_seconds) in other.items():
+        entry = _entry(path, recorded)
+        entry[0] += count
+        entry[1] += total
+        entry[2] += child
+        entry[3] += nbytes
+        entry[4] = [a + b for a, b in zip(entry[4], buckets)]
+        entry[6] = max(entry[6], max_seconds)
+
+
+# Latency of rank round(q% of (count - 1)) in the sorted latencies: upper edge of its bucket, at most the maximum
+def _percentile(buckets, count, max_seconds, q):
+    rank = min(count - 1, max(0, int(round(q / 100.0 * (count - 1)))))
+    seen = 0
+    for k, n in enumerate(buckets):
+        seen += n
+        if seen > rank:
+            return min(_upper_edge(k), max_seconds)
+    return max_seconds
+
+
+def summary():
+    result = {}
+    for path, (count, total, child, nbytes, buckets, _, max_seconds) in sorted(_stats.items()):
+        histogram = [0] * (len(HISTOGRAM_EDGES) + 1)
+        for k, n in enumerate(buckets):
+            if n:
+                edge = 0
+                while edge < len(HISTOGRAM_EDGES) and _upper_edge(k) > HISTOGRAM_EDGES[edge] * (1 + 1e-9):
+                    edge += 1
+                histogram[edge] += n
+        result[path] = {
+            "count": count,
+            "total_s": total,
+            "self_s": total - child,
+            "mean_s": total / count,
+            "p50_s": _percentile(buckets, count, max_seconds, 50),
+            "p90_s": _percentile(buckets, count, max_seconds, 90),
+            "p99_s": _percentile(buckets, count, max_seconds, 99),
+            "max_s": max_seconds,
+            "bytes": nbytes,
+            "mb_per_s": nbytes / 2 ** 20 / total if total > 0 else 0.0,
+            "histogram": {f"<={edge_s:g}s": n for edge_s, n in zip(HISTOGRAM_EDGES, histogram)}
+                         | {f">{HISTOGRAM_EDGES[-1]:g}s": histogram[-1]},
+        }
+    return result
+
+
+def export_json(path):
+    with open(path, "w") as f:
+        json.dump(summary(), f, indent=2)
+
+
+# Collapsed stacks "stage;nested_stage;... <self microseconds>", one line for each stage (not the record()ed latencies)
+def flame_summary():
+    return "\n".join(f"{path} {max(0, round((entry[1] - entry[2]) * 1e6))}"
+                     for path, entry in sorted(_stats.items()) if not entry[5])
+
+
+def print_report():
+    print(f"{'stage':<50}{'count':>9}{'total s':>10}{'self s':>10}{'p50 ms':>10}{'p99 ms':>10}{'MB/s':>10}")
+    for path, row in summary().items():
+        depth = path.count(";")
+        name = "  " * depth + path.rsplit(";", 1)[-1]
+        print(f"{name:<50}{row['count']:>9}{row['total_s']:>10.3f}{row['self_s']:>10.3f}"
+              f"{row['p50_s'] * 1e3:>10.3f}{row['p99_s'] * 1e3:>10.3f}{row['mb_per_s']:>10.1f}")
@@ -0,0 +1,102 @@
+import numpy as np
+
+
+# Inference of SeleneModel (90 -> 64 -> 32 -> 16 -> 4 dense network) with NumPy only.
+#
+# Importing TensorFlow takes seconds and hundreds of MB, while the forward pass of this network is four small
+# matrix products. export_npz writes the kernels and biases of the hl1, hl2, hl3 and tail layers of a trained
+# model into a .npz file (float32, "<layer>/kernel" and "<layer>/bias" arrays); NumpySeleneModel loads it and
+# computes the same softmax of SeleneModel.predict, within float32 tolerance, for batches of any size.
+# This module never imports TensorFlow: export_npz and import_npz only use the layers of the model they are given.
+
+LAYER_NAMES = ["hl1", "hl2", "hl3", "tail"]
+CHUNK_ROWS = 4096  # rows computed at a time, so the activation buffers stay small and in cache
+
+
+# (kernel, bias) of the LAYER_NAMES of model, a SeleneModel or its Keras model
+def model_layers(model):
+    keras_model = getattr(model, "model", model)
+    return [tuple(keras_model.get_layer(name).get_weights()) for name in LAYER_NAMES]
+
+
+def export_npz(model, path):
+    arrays = {}
+    for name, (kernel, bias) in zip(LAYER_NAMES, model_layers(model)):
+        arrays[f"{name}/kernel"] = np.asarray(kernel, dtype=np.float32)
+        arrays[f"{name}/bias"] = np.asarray(bias, dtype=np.float32)
+    np.savez(path, **arrays)
+
+
+# Inverse of export_npz: sets the weights of the layers of model (SeleneModel or its Keras model) from the file
+def import_npz(model, path):
+    keras_model = getattr(model, "model", model)
+    with np.load(path) as arrays:
+        for name in LAYER_NAMES:
+            keras_model.get_layer(name).set_weights([arrays[f"{name}/kernel"], arrays[f"{name}/bias"]])
+
+
+class NumpySeleneModel:
+
+    # layers: list of (kernel, bias) from the first hidden layer to the tail; ReLU on all of them but the tail
+    def __init__(self, layers, chunk_rows=CHUNK_ROWS):
+        self.kernels = [np.ascontiguousarray(kernel, dtype=np.float32) for kernel, _ in layers]
+        self.biases = [np.ascontiguousarray(bias, dtype=np.float32) for _, bias in layers]
+        for previous, kernel in zip(self.kernels, self.kernels[1:]):
+            if previous.shape[1] != kernel.shape[0]:
+                raise ValueError(f"Layer shapes do not match: {previous.shape} -> {kernel.shape}")
+
+        self.input_size = self.kernels[0].shape[0]
+        self.num_classes = self.kernels[-1].shape[1]
+        self.chunk_rows = chunk_rows
+        # One activation buffer per layer, reused by every call
+        self._buffers = [np.empty((chunk_rows, kernel.shape[1]), dtype=np.float32) for kernel in self.kernels]
+        self._input = np.empty((chunk_rows, self.input_size), dtype=np.float32)
+        self._row_max = np.empty((chunk_rows, 1), dtype=np.float32)
+
+    @classmethod
+    def load(cls, path, chunk_rows=CHUNK_ROWS):
+        with np.load(path) as arrays:
+            layers = [(arrays[f"{name}/kernel"], arrays[f"{name}/bias"]) for name in LAYER_NAMES]
+        return cls(layers, chunk_rows)
+
+    # Copy of the current weights of a SeleneModel (or its Keras model), without going through a file
+    @classmethod
+    def from_model(cls, model, chunk_rows=CHUNK_ROWS):
+        return cls(model_layers(model), chunk_rows)
+
+    # Softmax probabilities, shape (n, num_classes), for x of shape (n, 90) (or a single vector of 90 values)
+    def predict_proba(self, x):
+        x = np.asarray(x)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        if x.ndim != 2 or x.shape[1] != self.input_size:
+            raise ValueError(f"Expected inputs of shape (n, {self.input_size}), got {x.shape}")
+
+        probs = np.empty((x.shape[0], self.num_classes), dtype=np.float32)
+        for start in range(0, x.shape[0], self.chunk_rows):
+            stop = min(start + self.chunk_rows, x.shape[0])
+            self._forward(x[start:stop], probs[start:stop])
+        return probs
+
+    def predict(self, x):
+        return np.argmax(self.predict_proba(x), axis=1)
+
+    def _forward(self, x, out):
+        n = x.shape[0]
+        inputs = self._input[:n]
+        inputs[...] = x  # float32 conversion, as the TensorSpec of SeleneModel.predict
+        last = len(self.kernels) - 1
+        for i, (kernel, bias) in enumerate(zip(self.kernels, self.biases)):
+            activations = self._buffers[i][:n]
+            np.matmul(inputs, kernel, out=activations)
+            activations += bias
+            if i < last:
+                np.maximum(activations, 0.0, out=activations)
+            inputs = activations
+
+        # Softmax, shifted by the max of each row as tf.nn.softmax
+        row_max = self._row_max[:n]
+        np.max(inputs, axis=1, keepdims=True, out=row_max)
+        np.subtract(inputs, row_max, out=out)
+        np.exp(out, out=out)
+        out /= out.sum(axis=1, keepdims=True)
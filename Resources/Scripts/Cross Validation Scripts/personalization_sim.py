@@ -0,0 +1,188 @@
+import time
+
+import numpy as np
+
+from finetune_sessions import split_finetune_data
+
+
+# Simulation of the fine tuning of many users at once, to estimate how personalization behaves across the fleet.
+#
+# Every simulated user gets its own split of the selene-db sessions (split_finetune_data with a seed per user) and
+# its own distortion of the features: a gain per feature drawn from a log-normal distribution of sigma gain_sigma,
+# as electrodes and skull change the amplitudes from subject to subject.
+# All the users share the frozen backbone of the base model (head, hl1, hl2): its 32 hl2 activations are computed
+# once for every vector of every user. The trainable heads (hl3 and tail) of all the users are stacked in arrays
+# with the user as first axis, so every step of the fine tuning is one batched matmul (and its gradient) across the
+# users, instead of one SeleneModel and one run_training per user.
+# The step is the one of SeleneModel.head_step (addest.py): softmax cross entropy, gradient clipped to norm 1 for
+# every variable, SGD with momentum, here with the momentum state of each user. Users with fewer fine tuning
+# vectors than the others skip the steps past the end of their epoch.
+# NumPy only: TensorFlow is never imported.
+
+LEARNING_RATE = 0.001  # as the optimizer of SeleneModel
+MOMENTUM = 0.80
+CLIP_NORM = 1.0  # as train_step
+FINETUNE_EPOCHS = 50  # as finetune_and_evaluate
+USER_GAIN_SIGMA = 0.1
+
+
+# hl2 activations of x (..., 90) with the base model arrays of numpy_model.export_npz
+def backbone_activations(arrays, x):
+    h = np.maximum(x @ arrays["hl1/kernel"] + arrays["hl1/bias"], 0.0)
+    return np.maximum(h @ arrays["hl2/kernel"] + arrays["hl2/bias"], 0.0).astype(np.float32)
+
+
+def _clip(gradient, axes):
+    norm = np.sqrt(np.sum(gradient * gradient, axis=axes, keepdims=True))
+    return gradient * (CLIP_NORM / np.maximum(norm, CLIP_NORM))
+
+
+class HeadBatch:
+
+    # Heads of n_users users, all starting from the hl3 and tail of the base model, with zero momentum
+    def __init__(self, arrays, n_users):
+        self.weights = [np.repeat(np.asarray(arrays[key], dtype=np.float32)[None], n_users, axis=0)
+                        for key in ("hl3/kernel", "hl3/bias", "tail/kernel", "tail/bias")]
+        self.momentums = [np.zeros_like(weight) for weight in self.weights]
+        self.n_users = n_users
+
+    # Logits (n_users, n, 4) of the activations h (n_users, n, 32)
+    def logits(self, h):
+        kernel3, bias3, kernel_tail, bias_tail = self.weights
+        hidden = np.maximum(np.matmul(h, kernel3) + bias3[:, None], 0.0)
+        return np.matmul(hidden, kernel_tail) + bias_tail[:, None]
+
+    def probabilities(self, h):
+        logits = self.logits(h)
+        logits -= logits.max(axis=-1, keepdims=True)
+        np.exp(logits, out=logits)
+        return logits / logits.sum(axis=-1, keepdims=True)
+
+    # One SGD step of every user on its vector h (n_users, 32) and one-hot label y (n_users, 4); the users where
+    # active is False keep weights and momentum. Returns the loss of every user
+    def step(self, h, y, active):
+        kernel3, bias3, kernel_tail, bias_tail = self.weights
+        z3 = np.matmul(h[:, None], kernel3)[:, 0] + bias3
+        hidden = np.maximum(z3, 0.0)
+        logits = np.matmul(hidden[:, None], kernel_tail)[:, 0] + bias_tail
+
+        shifted = logits - logits.max(axis=1, keepdims=True)
+        log_probs = shifted - np.log(np.exp(shifted).sum(axis=1, keepdims=True))
+        loss = -np.sum(y * log_probs, axis=1)
+
+        d_logits = np.exp(log_probs) - y
+        d_z3 = np.matmul(d_logits[:, None], kernel_tail.transpose(0, 2, 1))[:, 0] * (z3 > 0)
+        gradients = [
+            _clip(h[:, :, None] * d_z3[:, None], (1, 2)),
+            _clip(d_z3, (1,)),
+            _clip(hidden[:, :, None] * d_logits[:, None], (1, 2)),
+            _clip(d_logits, (1,)),
+        ]
+
+        mask = active.astype(np.float32)
+        for weight, momentum, gradient in zip(self.weights, self.momentums, gradients):
+            user_mask = mask.reshape((-1,) + (1,) * (weight.ndim - 1))
+            # momentum = MOMENTUM * momentum - LEARNING_RATE * gradient, weight += momentum, only for active users
+            momentum += user_mask * ((MOMENTUM - 1.0) * momentum - LEARNING_RATE * gradient)
+            weight += user_mask * momentum
+        return loss
+
+
+# Rows of the arrays of every user stacked in (n_users, longest, ...) with zeros after the end, and the lengths
+def _pad(arrays):
+    lengths = np.array([len(array) for array in arrays])
+    padded = np.zeros((len(arrays), max(lengths.max(), 1)) + arrays[0].shape[1:], dtype=np.float32)
+    for user, array in enumerate(arrays):
+        padded[user, :len(array)] = array
+    return padded, lengths
+
+
+# Fine tuning and test data of n_users simulated users, as hl2 activations of the base model
+def simulate_users(arrays, finetune_data, n_users, seed=0, gain_sigma=USER_GAIN_SIGMA, num_classes=4):
+    rng = np.random.default_rng(seed)
+    h_ft, y_ft, h_test, y_test = [], [], [], []
+    for user in range(n_users):
+        x_ft, y_ft_raw, x_test, y_test_raw = split_finetune_data(finetune_data, seed + user)
+        gain = np.exp(rng.normal(0.0, gain_sigma, size=x_ft.shape[1]))
+        h_ft.append(backbone_activations(arrays, x_ft * gain))
+        h_test.append(backbone_activations(arrays, x_test * gain))
+        y_ft.append(np.eye(num_classes, dtype=np.float32)[np.asarray(y_ft_raw, dtype=int) % num_classes])
+        y_test.append(np.asarray(y_test_raw, dtype=int) % num_classes)
+    return h_ft, y_ft, h_test, y_test
+
+
+def _evaluate(heads, h_test, test_lengths, y_test):
+    probs = heads.probabilities(h_test)
+    accuracy, loss = np.zeros(heads.n_users), np.zeros(heads.n_users)
+    for user, n in enumerate(test_lengths):
+        if n:
+            accuracy[user] = np.mean(np.argmax(probs[user, :n], axis=1) == y_test[user])
+            loss[user] = -np.mean(np.log(np.maximum(probs[user, np.arange(n), y_test[user]], 1e-7)))
+    return accuracy, loss
+
+
+def run_simulation(model_path, finetune_data, n_users=100, epochs=FINETUNE_EPOCHS, seed=0,
+                   gain_sigma=USER_GAIN_SIGMA):
+    with np.load(model_path) as arrays:
+        arrays = {key: arrays[key] for key in arrays.files}
+
+    begin = time.perf_counter()
+    h_ft, y_ft, h_test, y_test = simulate_users(arrays, finetune_data, n_users, seed, gain_sigma)
+    h_ft, ft_lengths = _pad(h_ft)
+    y_ft, _ = _pad(y_ft)
+    h_test, test_lengths = _pad(h_test)
+    prepare_s = time.perf_counter() - begin
+
+    heads = HeadBatch(arrays, n_users)
+    accuracy_before, loss_before = _evaluate(heads, h_test, test_lengths, y_test)
+
+    rng = np.random.default_rng(seed)
+    users = np.arange(n_users)
+    steps = h_ft.shape[1]
+    epoch_losses = np.zeros((epochs, n_users))
+    begin = time.perf_counter()
+    for epoch in range(epochs):
+        # A new order of its own vectors for every user; the padding rows stay after them
+        order = np.argsort(rng.random((n_users, steps)) + (np.arange(steps) >= ft_lengths[:, None]), axis=1)
+        for step in range(steps):
+            index = order[:, step]
+            active = step < ft_lengths
+            epoch_losses[epoch] += heads.step(h_ft[users, index], y_ft[users, index], active) * active
+    train_s = time.perf_counter() - begin
+    epoch_losses /= np.maximum(ft_lengths, 1)
+
+    accuracy_after, loss_after = _evaluate(heads, h_test, test_lengths, y_test)
+    return {
+        "users": n_users,
+        "epochs": epochs,
+        "prepare_s": prepare_s,
+        "train_s": train_s,
+        "users_per_s": n_users / train_s if train_s > 0 else 0.0,
+        "steps_per_s": epochs * steps / train_s if train_s > 0 else 0.0,
+        "per_user": [
+            {"finetune_vectors": int(ft_lengths[user]), "test_vectors": int(test_lengths[user]),
+             "accuracy_before": float(accuracy_before[user]), "accuracy_after": float(accuracy_after[user]),
+             "test_loss_before": float(loss_before[user]), "test_loss_after": float(loss_after[user]),
+             "final_train_loss": float(epoch_losses[-1, user]) if epochs else None}
+            for user in range(n_users)
+        ],
+    }
+
+
+def print_simulation_report(report, show_users=10):
+    per_user = report["per_user"]
+    before = np.array([user["accuracy_before"] for user in per_user])
+    after = np.array([user["accuracy_after"] for user in per_user])
+    print(f"{'user':>6}{'ft vectors':>12}{'test vectors':>14}{'acc before':>12}{'acc after':>12}{'train loss':>12}")
+    for i, user in enumerate(per_user[:show_users]):
+        train_loss = user["final_train_loss"]
+        print(f"{i:>6}{user['finetune_vectors']:>12}{user['test_vectors']:>14}{user['accuracy_before']:>12.4f}"
+              f"{user['accuracy_after']:>12.4f}{train_loss if train_loss is not None else float('nan'):>12.4f}")
+    if len(per_user) > show_users:
+        print(f"... {len(per_user) - show_users} more users")
+    print(f"Accuracy before fine tuning: mean {before.mean():.4f}, after: mean {after.mean():.4f}, "
+          f"p10 {np.percentile(after, 10):.4f}, p90 {np.percentile(after, 90):.4f}; "
+          f"improved for {np.mean(after > before):.1%} of the users")
+    print(f"{report['users']} users x {report['epochs']} epochs trained in {report['train_s']:.2f} s: "
+          f"{report['users_per_s']:.1f} users/s, {report['steps_per_s']:.0f} batched steps/s "
+          f"(features and activations prepared in {report['prepare_s']:.2f} s)")
@@ -0,0 +1,367 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+# Single command line entry point of the scripts:
+#   python selene_cli.py synth-db       --sessions 34000 --out synthetic-selene-db
+#   python selene_cli.py featurize      --db selene-db --out finetune_features.npz
+#   python selene_cli.py train          --data ./ --out model.npz
+#   python selene_cli.py crossval       --db selene-db --folds 10
+#   python selene_cli.py finetune-eval  --model model.npz --features finetune_features.npz
+#   python selene_cli.py export-tflite  --model model.npz --out trainable_model.tflite
+#   python selene_cli.py export-tflite  --model model.npz --quantize int8 float16
+#   python selene_cli.py quant-report   --folds 10 --out quantization.json
+#   python selene_cli.py simulate       --model model.npz --features finetune_features.npz --users 500
+#   python selene_cli.py tflite-bench   --tflite trainable_model.tflite --model model.npz --features finetune_features.npz
+#   python selene_cli.py bench imports | run --out bench.json | compare baseline.json bench.json
+#
+# Only argparse and the standard library are imported here: every subcommand imports its own modules when it runs,
+# so featurize (NumPy, SciPy, PyWavelets) never pays the startup of TensorFlow and scikit-learn, which only the
+# subcommands that build a SeleneModel load (through addest.py). "bench imports" checks these import times against
+# IMPORT_BUDGETS, each one measured in a new interpreter.
+
+# subcommands -> (modules imported when they run, seconds allowed for the import, modules that must not be loaded)
+# Budgets are about twice the times measured on a single core machine with warm disk caches (0.01 s for the
+# CLI alone, 1.2 s for featurize, 5.5 s for the subcommands using addest.py)
+IMPORT_BUDGETS = {
+    "cli": ([], 0.2, ["numpy", "tensorflow", "sklearn", "pandas"]),
+    "featurize": (["finetune_sessions"], 2.5, ["tensorflow", "sklearn", "pandas"]),
+    "simulate": (["personalization_sim"], 2.5, ["tensorflow", "sklearn", "pandas"]),
+    "train, crossval, finetune-eval, export-tflite, tflite-bench, quant-report": (["addest"], 12.0, []),
+}
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def cmd_featurize(args):
+    import numpy as np
+    from finetune_sessions import featurize_finetune_sessions
+
+    finetune_data = featurize_finetune_sessions(args.db, args.block_size, args.cache_dir, args.hop)
+    np.savez(args.out, **finetune_data)
+    print(f"{len(finetune_data['X'])} feature vectors of {len(finetune_data['label_sessions'])} sessions "
+          f"written to {args.out}")
+
+
+def cmd_synth_db(args):
+    from synthetic_db import generate_selene_db
+
+    labels = generate_selene_db(args.out, args.sessions, args.duration, args.class_weights, args.seed,
+                                overwrite=args.overwrite)
+    counts = ", ".join(f"{label}: {(labels == label).sum()}" for label in range(len(args.class_weights)))
+    print(f"{args.sessions} sessions of {args.duration} s written to {args.out} (sessions per label {counts})")
+
+
+def cmd_train(args):
+    import numpy as np
+    from addest import NUM_CLASSES, SeleneModel, evaluate_model, load_data_from_folder, preprocess_labels, run_training
+    from numpy_model import export_npz
+
+    splits = {}
+    for split in ("train", "validation", "test"):
+        X, y_raw = load_data_from_folder(os.path.join(args.data, split), args.parse_workers)
+        splits[split] = (X.astype(np.float32), preprocess_labels(y_raw, NUM_CLASSES).astype(np.float32))
+
+    model = SeleneModel(inputShape=(splits["train"][0].shape[1],), numClasses=NUM_CLASSES)
+    run_training(model, *splits["train"], *splits["validation"], batch_size=1, epochs=args.epochs,
+                 patience=args.patience, compiled=True, seed=args.seed, log_every=args.log_every)
+    evaluate_model(model, *splits["test"])
+
+    export_npz(model, args.out)
+    print(f"Model weights written to {args.out}")
+
+
+def cmd_crossval(args):
+    from addest import run_crossval
+
+    run_crossval(args.db, args.folds, args.workers, args.cache_dir, args.parse_workers)
+
+
+def cmd_finetune_eval(args):
+    from addest import NUM_CLASSES, SeleneModel, finetune_and_evaluate
+    from numpy_model import import_npz
+
+    if args.features is not None:
+        import numpy as np
+
+        with np.load(args.features) as arrays:
+            finetune_data = dict(arrays)
+    else:
+        from finetune_sessions import featurize_finetune_sessions
+
+        finetune_data = featurize_finetune_sessions(args.db, cache_dir=args.cache_dir)
+
+    model = SeleneModel(inputShape=(finetune_data["X"].shape[1],), numClasses=NUM_CLASSES)
+    import_npz(model, args.model)
+    result = finetune_and_evaluate(model, finetune_data, args.seed, args.out, args.model)
+    if args.head_out:
+        from head_checkpoint import save_head
+
+        save_head(model, args.head_out)
+        print(f"Fine tuned hl3 and tail written to {args.head_out} ({os.path.getsize(args.head_out)} bytes)")
+    print("Classification Report:")
+    print(json.dumps(result["report"], indent=2))
+
+
+def cmd_export_tflite(args):
+    from addest import NUM_CLASSES, SeleneModel, export_tflite
+    from numpy_model import import_npz
+
+    model = SeleneModel(numClasses=NUM_CLASSES)
+    import_npz(model, args.model)
+    export_tflite(model, args.out, args.saved_model)
+
+    if args.quantize:
+        from tflite_quantization import export_predict_tflite
+
+        base = os.path.splitext(args.out)[0]
+        for quantization in args.quantize:
+            export_predict_tflite(model, f"{base}_predict_{quantization}.tflite", quantization,
+                                  args.saved_model + "_predict")
+
+
+def cmd_simulate(args):
+    from personalization_sim import print_simulation_report, run_simulation
+
+    if args.features is not None:
+        import numpy as np
+
+        with np.load(args.features) as arrays:
+            finetune_data = dict(arrays)
+    else:
+        from finetune_sessions import featurize_finetune_sessions
+
+        finetune_data = featurize_finetune_sessions(args.db, cache_dir=args.cache_dir or None)
+
+    report = run_simulation(args.model, finetune_data, args.users, args.epochs, args.seed, args.gain_sigma)
+    print_simulation_report(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.out}")
+
+
+def cmd_quant_report(args):
+    from tflite_quantization import print_quantization_report, run_quantization_report
+
+    report = run_quantization_report(args.folds, args.out_dir, args.model, args.epochs, args.patience, args.seed)
+    print_quantization_report(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.out}")
+
+
+def cmd_tflite_bench(args):
+    from tflite_harness import print_report, run_harness
+
+    if args.features is not None:
+        import numpy as np
+
+        with np.load(args.features) as arrays:
+            finetune_data = dict(arrays)
+    else:
+        from finetune_sessions import featurize_finetune_sessions
+
+        finetune_data = featurize_finetune_sessions(args.db, cache_dir=args.cache_dir or None)
+
+    report = run_harness(args.tflite, args.model, finetune_data, args.seed, args.epochs, args.batch_size,
+                         args.flex_delegate)
+    print_report(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.out}")
+    return 0 if report["passed"] else 1
+
+
+# Import time of the modules of a subcommand in a new interpreter, and which of the forbidden modules it loaded
+def measure_import(modules, forbidden):
+    code = (
+        "import sys, time, json\n"
+        f"sys.path.insert(0, {SCRIPTS_DIR!r})\n"
+        "t = time.perf_counter()\n"
+        f"for name in {['selene_cli'] + modules!r}: __import__(name)\n"
+        "elapsed = time.perf_counter() - t\n"
+        f"print(json.dumps([elapsed, [m for m in {forbidden!r} if m in sys.modules]]))\n"
+    )
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_imports(args):
+    failed = []
+    print(f"{'subcommands':<48}{'import s':>10}{'budget s':>10}  result")
+    for name, (modules, budget, forbidden) in IMPORT_BUDGETS.items():
+        elapsed, loaded = min((measure_import(modules, forbidden) for _ in range(args.repeat)), key=lambda r: r[0])
+        ok = elapsed <= budget and not loaded
+        if not ok:
+            failed.append(name)
+        result = "ok" if ok else "OVER BUDGET" if not loaded else f"loads {', '.join(loaded)}"
+        print(f"{name:<48}{elapsed:>10.3f}{budget:>10.1f}  {result}")
+    if failed:
+        print(f"Import budget exceeded by: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+def bench_run(args):
+    import bench_suite
+
+    results = bench_suite.run_suite(args.cases, args.sizes, args.repeat, args.max_seconds)
+    bench_suite.save_results(results, args.out)
+    print(f"Results written to {args.out}")
+
+
+def bench_compare(args):
+    import bench_suite
+
+    rows, regressions = bench_suite.compare_results(bench_suite.load_results(args.baseline),
+                                                    bench_suite.load_results(args.current), args.threshold)
+    bench_suite.print_comparison(rows, regressions, args.threshold)
+    return 1 if regressions else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="selene_cli.py", description="Mental workload model scripts")
+    parser.add_argument("--instrument", metavar="JSON", default=None,
+                        help="time the pipeline stages and write them to JSON (see instrumentation.py)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("featurize", help="feature vectors of the sessions of a selene-db")
+    p.add_argument("--db", default="selene-db")
+    p.add_argument("--block-size", type=int, default=16000)
+    p.add_argument("--hop", type=int, default=None, help="use every window moving by HOP samples, not only the first")
+    p.add_argument("--cache-dir", default="feature-cache")
+    p.add_argument("--out", default="finetune_features.npz")
+    p.set_defaults(func=cmd_featurize)
+
+    p = subparsers.add_parser("synth-db", help="write a selene-db with synthetic sessions (see synthetic_db.py)")
+    p.add_argument("--out", default="synthetic-selene-db")
+    p.add_argument("--sessions", type=int, default=34)
+    p.add_argument("--duration", type=float, default=32.0, help="seconds of every session")
+    p.add_argument("--class-weights", type=float, nargs="+", default=[1, 1, 1, 1], help="proportions of labels 0-3")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--overwrite", action="store_true")
+    p.set_defaults(func=cmd_synth_db)
+
+    p = subparsers.add_parser("train", help="train the base model on the train, validation and test folders")
+    p.add_argument("--data", default="./", help="folder with train/, validation/, test/ and their labels .csv")
+    p.add_argument("--epochs", type=int, default=10000)
+    p.add_argument("--patience", type=int, default=200)
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--log-every", type=int, default=100, help="print the loss every LOG_EVERY steps, 0 never")
+    p.add_argument("--out", default="model.npz")
+    p.add_argument("--parse-workers", type=int, default=1, help="processes parsing the .xlsx files of a new split")
+    p.set_defaults(func=cmd_train)
+
+    p = subparsers.add_parser("crossval", help="cross validation over the stage_* folders, with fine tuning")
+    p.add_argument("--db", default="selene-db")
+    p.add_argument("--folds", type=int, default=10)
+    p.add_argument("--workers", type=int, default=min(10, os.cpu_count() or 1))
+    p.add_argument("--cache-dir", default="feature-cache")
+    p.add_argument("--parse-workers", type=int, default=1, help="processes parsing the .xlsx files of a new split")
+    p.set_defaults(func=cmd_crossval)
+
+    p = subparsers.add_parser("finetune-eval", help="fine tune a trained model on the sessions and evaluate it")
+    p.add_argument("--model", default="model.npz")
+    p.add_argument("--features", default=None, help=".npz written by featurize, instead of reading --db")
+    p.add_argument("--db", default="selene-db")
+    p.add_argument("--cache-dir", default="feature-cache")
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--out", default="finetuned.npz")
+    p.add_argument("--head-out", default=None, help="also write the fine tuned head as a delta checkpoint")
+    p.set_defaults(func=cmd_finetune_eval)
+
+    p = subparsers.add_parser("export-tflite", help="convert a trained model to a trainable .tflite")
+    p.add_argument("--model", default="model.npz")
+    p.add_argument("--saved-model", default="saved_model")
+    p.add_argument("--out", default="trainable_model.tflite")
+    p.add_argument("--quantize", nargs="+", default=[], choices=["int8", "float16"],
+                   help="also write builtins-only predict models, OUT_predict_<quantization>.tflite")
+    p.set_defaults(func=cmd_export_tflite)
+
+    p = subparsers.add_parser("simulate", help="fine tune many simulated users at once (see personalization_sim.py)")
+    p.add_argument("--model", default="model.npz")
+    p.add_argument("--features", default=None, help=".npz written by featurize, instead of reading --db")
+    p.add_argument("--db", default="selene-db")
+    p.add_argument("--cache-dir", default="feature-cache", help="empty string to disable the feature cache")
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--epochs", type=int, default=50)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--gain-sigma", type=float, default=0.1, help="spread of the per user feature gains (log-normal)")
+    p.add_argument("--out", default=None, help="also write the per user metrics as JSON")
+    p.set_defaults(func=cmd_simulate)
+
+    p = subparsers.add_parser("quant-report", help="compare quantized predict models with the float model per stage")
+    p.add_argument("--folds", type=int, default=10)
+    p.add_argument("--model", default=None, help="weights (.npz) of one trained model, instead of training each stage")
+    p.add_argument("--epochs", type=int, default=100)
+    p.add_argument("--patience", type=int, default=10)
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--out-dir", default="quantized", help="folder of the exported models")
+    p.add_argument("--out", default=None, help="also write the report as JSON")
+    p.set_defaults(func=cmd_quant_report)
+
+    p = subparsers.add_parser("tflite-bench", help="replay fine tuning and scoring on the .tflite and compare with Keras")
+    p.add_argument("--tflite", default="trainable_model.tflite")
+    p.add_argument("--model", default="model.npz", help="weights the .tflite was exported from")
+    p.add_argument("--features", default=None, help=".npz written by featurize, instead of reading --db")
+    p.add_argument("--db", default="selene-db")
+    p.add_argument("--cache-dir", default="feature-cache", help="empty string to disable the feature cache")
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--epochs", type=int, default=20, help="fine tuning epochs, as FineTuningService")
+    p.add_argument("--batch-size", type=int, default=64, help="vectors scored by each predict invoke")
+    p.add_argument("--flex-delegate", default=None, help="libtensorflowlite_flex to run train, save and load_weights")
+    p.add_argument("--out", default=None, help="also write the report as JSON")
+    p.set_defaults(func=cmd_tflite_bench)
+
+    p = subparsers.add_parser("bench", help="import time budgets and benchmarks of the hot paths (see bench_suite.py)")
+    bench_parsers = p.add_subparsers(dest="bench_command", required=True)
+
+    b = bench_parsers.add_parser("imports", help="check the import time of every subcommand against its budget")
+    b.add_argument("--repeat", type=int, default=3)
+    b.set_defaults(func=bench_imports)
+
+    b = bench_parsers.add_parser("run", help="run the benchmark suite and save the results as JSON")
+    b.add_argument("--cases", nargs="+", default=None, help="default: all the cases")
+    b.add_argument("--sizes", nargs="+", default=None, choices=["1x16000", "100x16000", "1h"])
+    b.add_argument("--repeat", type=int, default=5)
+    b.add_argument("--max-seconds", type=float, default=20.0, help="stop repeating a case after this time")
+    b.add_argument("--out", default="bench.json")
+    b.set_defaults(func=bench_run)
+
+    b = bench_parsers.add_parser("compare", help="flag the cases slower than a baseline")
+    b.add_argument("baseline")
+    b.add_argument("current")
+    b.add_argument("--threshold", type=float, default=0.10, help="relative slowdown flagged as regression")
+    b.set_defaults(func=bench_compare)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sys.path.insert(0, SCRIPTS_DIR)
+    if args.instrument:
+        import instrumentation
+        instrumentation.enable()
+
+    start = time.perf_counter()
+    status = args.func(args)
+    print(f"{args.command} done in {time.perf_counter() - start:.1f} s")
+
+    if args.instrument:
+        instrumentation.print_report()
+        instrumentation.export_json(args.instrument)
+        with open(os.path.splitext(args.instrument)[0] + ".folded", "w") as f:
+            f.write(instrumentation.flame_summary() + "\n")
+        print(f"Stage timings written to {args.instrument} (collapsed stacks in .folded)")
+    return status or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+import os
+import sqlite3
+
+import numpy as np
+
+from instrumentation import instrumented, stage
+
+
+# Bulk reader of the EEG sessions stored by the app in the SampleEeg table (selene-db).
+#
+# - All session labels come from one grouped query, instead of one "SELECT tiredness ... LIMIT 1" per session.
+# - Channel rows are read through an index on (session_id, timestamp), so each session is a range scan already
+#   in timestamp order, and are streamed with fetchmany straight into a preallocated float64 (6, block_size) array.
+# - Whole sessions can also be streamed as overlapping windows, keeping in memory only one window at a time.
+# The app database has no such index: if it is missing, it is created on a copy of the database (the original
+# file is never modified) and the copy is reused until the original changes.
+
+CHANNEL_COLUMNS = ["channel_c1", "channel_c2", "channel_c3", "channel_c4", "channel_c5", "channel_c6"]
+SESSION_INDEX_NAME = "index_SampleEeg_session_id_timestamp"
+FETCH_ROWS = 65536
+
+
+def has_session_index(conn):
+    for index in conn.execute("PRAGMA index_list(SampleEeg)").fetchall():
+        columns = [row[2] for row in conn.execute(f"PRAGMA index_info('{index[1]}')").fetchall()]
+        if columns[:2] == ["session_id", "timestamp"]:
+            return True
+    return False
+
+
+# Path of a database with the (session_id, timestamp) index: db_path itself, or an indexed copy of it
+def ensure_session_index(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        if has_session_index(conn):
+            return db_path
+
+        indexed_path = db_path + ".indexed"
+        if os.path.exists(indexed_path) and os.path.getmtime(indexed_path) >= os.path.getmtime(db_path):
+            return indexed_path
+
+        print(f"Creating session index on a copy of {db_path} ({indexed_path})...")
+        tmp_path = indexed_path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        copy = sqlite3.connect(tmp_path)
+        try:
+            conn.backup(copy)
+            copy.execute(f"CREATE INDEX IF NOT EXISTS {SESSION_INDEX_NAME} ON SampleEeg (session_id, timestamp)")
+            copy.commit()
+        finally:
+            copy.close()
+        os.replace(tmp_path, indexed_path)
+        return indexed_path
+    finally:
+        conn.close()
+
+
+# session_id -> tiredness, taken from the first stored row of each session as in the per-session queries
+@instrumented("sqlite_fetch")
+def read_session_labels(cursor):
+    cursor.execute("""
+        SELECT session_id, tiredness, MIN(id)
+        FROM SampleEeg
+        GROUP BY session_id
+        ORDER BY session_id
+    """)
+    return {session_id: tiredness for session_id, tiredness, _ in cursor.fetchall()}
+
+
+# First block_size samples of a session, in timestamp order, as a (6, block_size) array (None if shorter)
+def read_session_block(cursor, session_id, block_size, fetch_rows=FETCH_ROWS):
+    cursor.execute(f"""
+        SELECT {", ".join(CHANNEL_COLUMNS)}
+        FROM SampleEeg
+        WHERE session_id = ?
+        ORDER BY timestamp
+        LIMIT ?
+    """, (session_id, block_size))
+
+    block = np.empty((len(CHANNEL_COLUMNS), block_size), dtype=np.float64)
+    filled = 0
+    while True:
+        with stage("sqlite_fetch"):
+            rows = cursor.fetchmany(fetch_rows)
+        if not rows:
+            break
+        block[:, filled:filled + len(rows)] = np.array(rows, dtype=np.float64).T
+        filled += len(rows)
+
+    return block if filled == block_size else None
+
+
+# Yields (session_id, tiredness, block) for every session with at least block_size samples
+def read_session_blocks(cursor, block_size, session_labels=None, fetch_rows=FETCH_ROWS):
+    if session_labels is None:
+        session_labels = read_session_labels(cursor)
+    for session_id, tiredness in session_labels.items():
+        block = read_session_block(cursor, session_id, block_size, fetch_rows)
+        if block is not None:
+            yield session_id, tiredness, block
+
+
+# Yields (start, window) for every window of `window` samples of a session, moving by `hop` samples, in timestamp
+# order. Rows are read with a cursor, so memory is bounded by one window plus one fetch, whatever the session length.
+def iter_session_windows(cursor, session_id, window, hop, fetch_rows=FETCH_ROWS):
+    if window <= 0 or hop <= 0:
+        raise ValueError(f"window and hop must be positive, got window={window} hop={hop}")
+
+    cursor.execute(f"""
+        SELECT {", ".join(CHANNEL_COLUMNS)}
+        FROM SampleEeg
+        WHERE session_id = ?
+        ORDER BY timestamp
+    """, (session_id,))
+
+    buffer = np.empty((len(CHANNEL_COLUMNS), window), dtype=np.float64)
+    filled = 0  # samples of the next window already in buffer
+    to_skip = 0  # samples to drop before the next window starts (only when hop > window)
+    start = 0  # position of the next window in the session
+    while True:
+        with stage("sqlite_fetch"):
+            rows = cursor.fetchmany(fetch_rows)
+        if not rows:
+            break
+        chunk = np.array(rows, dtype=np.float64).T
+
+        pos = 0
+        while pos < chunk.shape[1]:
+            if to_skip:
+                skipped = min(to_skip, chunk.shape[1] - pos)
+                to_skip -= skipped
+                pos += skipped
+                continue
+
+            taken = min(window - filled, chunk.shape[1] - pos)
+            buffer[:, filled:filled + taken] = chunk[:, pos:pos + taken]
+            filled += taken
+            pos += taken
+
+            if filled == window:
+                yield start, buffer.copy()
+                start += hop
+                if hop < window:
+                    buffer[:, :window - hop] = buffer[:, hop:]
+                    filled = window - hop
+                else:
+                    filled = 0
+                    to_skip = hop - window
+
+
+# Yields (session_id, tiredness, start, window) for all windows of all sessions
+def read_session_windows(cursor, window, hop, session_labels=None, fetch_rows=FETCH_ROWS):
+    if session_labels is None:
+        session_labels = read_session_labels(cursor)
+    for session_id, tiredness in session_labels.items():
+        for start, block in iter_session_windows(cursor, session_id, window, hop, fetch_rows):
+            yield session_id, tiredness, start, block
@@ -0,0 +1,120 @@
+import os
+import sqlite3
+
+import numpy as np
+
+
+# Generator of synthetic selene-db files, for load and scale tests of the pipeline without real subjects.
+#
+# The SampleEeg table is created with the same statement Room uses for the app database (version 5), so the
+# scripts read the generated files exactly as the real ones. Every session has one tiredness label (0-3), as after
+# the vote in StudyActivity, and 500 Hz samples in microvolts with timestamps 2 ms apart.
+# Each of the 6 channels is the sum of band-limited noise in the delta, theta, alpha and beta bands, with RMS
+# amplitudes that depend on the label (BAND_AMPLITUDES), 50 Hz mains noise of random amplitude and phase, and
+# white noise. The ear channels get only the mains and white noise, at a lower level.
+# Rows are generated and inserted one session at a time, so the size of the file is not limited by memory.
+
+SAMPLING_RATE = 500
+N_CHANNELS = 6
+BANDS = {"delta": (1.0, 4.0), "theta": (4.0, 8.0), "alpha": (8.0, 13.0), "beta": (13.0, 30.0)}
+# tiredness -> RMS amplitude (uV) of delta, theta, alpha, beta: with the workload theta and beta grow, alpha drops
+BAND_AMPLITUDES = {
+    0: (20.0, 8.0, 18.0, 4.0),
+    1: (20.0, 10.0, 14.0, 6.0),
+    2: (20.0, 12.0, 10.0, 8.0),
+    3: (20.0, 15.0, 7.0, 11.0),
+}
+MAINS_AMPLITUDE = (5.0, 30.0)  # range of the 50 Hz amplitude (uV), drawn for every session
+NOISE_RMS = 3.0
+START_TIMESTAMP = 1700000000000  # ms, first sample of the first session
+SESSION_GAP_MS = 60000
+INSERT_ROWS = 50000
+
+CREATE_SAMPLE_EEG = (
+    "CREATE TABLE IF NOT EXISTS `SampleEeg` (`id` INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "
+    "`timestamp` INTEGER NOT NULL, `channel_c1` REAL NOT NULL, `channel_c2` REAL NOT NULL, "
+    "`channel_c3` REAL NOT NULL, `channel_c4` REAL NOT NULL, `channel_c5` REAL NOT NULL, "
+    "`channel_c6` REAL NOT NULL, `channel_right_ear` REAL NOT NULL, `channel_left_ear` REAL NOT NULL, "
+    "`tiredness` INTEGER NOT NULL, `session_id` INTEGER NOT NULL)"
+)
+INSERT_SAMPLE_EEG = (
+    "INSERT INTO SampleEeg (timestamp, channel_c1, channel_c2, channel_c3, channel_c4, channel_c5, channel_c6, "
+    "channel_right_ear, channel_left_ear, tiredness, session_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+ROOM_DB_VERSION = 5
+
+
+# Labels of n_sessions sessions with the proportions of class_weights (largest remainder rounding), shuffled
+def session_labels(n_sessions, class_weights=(1, 1, 1, 1), rng=None):
+    rng = np.random.default_rng() if rng is None else rng
+    weights = np.asarray(class_weights, dtype=np.float64)
+    if weights.ndim != 1 or len(weights) > len(BAND_AMPLITUDES) or np.any(weights < 0) or weights.sum() <= 0:
+        raise ValueError(f"class_weights must be up to {len(BAND_AMPLITUDES)} non negative weights with a positive "
+                         f"sum, got {class_weights}")
+
+    exact = weights / weights.sum() * n_sessions
+    counts = np.floor(exact).astype(int)
+    for label in np.argsort(counts - exact)[:n_sessions - counts.sum()]:
+        counts[label] += 1
+    labels = np.repeat(np.arange(len(weights)), counts)
+    rng.shuffle(labels)
+    return labels
+
+
+# Noise with the given RMS and its power only between low and high Hz, shape (n_channels, n_samples)
+def band_noise(rng, n_channels, n_samples, low, high, rms, sampling_rate=SAMPLING_RATE):
+    spectrum = np.fft.rfft(rng.standard_normal((n_channels, n_samples)), axis=-1)
+    freqs = np.fft.rfftfreq(n_samples, 1.0 / sampling_rate)
+    spectrum[:, (freqs < low) | (freqs > high)] = 0.0
+    signal = np.fft.irfft(spectrum, n=n_samples, axis=-1)
+    return signal * (rms / np.sqrt(np.mean(signal ** 2, axis=-1, keepdims=True)))
+
+
+# (8, n_samples) signals of one session: the 6 channels and the right and left ear
+def session_signals(rng, tiredness, n_samples, sampling_rate=SAMPLING_RATE):
+    amplitudes = BAND_AMPLITUDES[tiredness]
+    signals = rng.normal(0.0, NOISE_RMS, size=(N_CHANNELS + 2, n_samples))
+    for (low, high), rms in zip(BANDS.values(), amplitudes):
+        signals[:N_CHANNELS] += band_noise(rng, N_CHANNELS, n_samples, low, high, rms, sampling_rate)
+
+    t = np.arange(n_samples) / sampling_rate
+    mains = rng.uniform(*MAINS_AMPLITUDE) * np.sin(2 * np.pi * 50.0 * t + rng.uniform(0, 2 * np.pi))
+    signals[:N_CHANNELS] += mains
+    signals[N_CHANNELS:] += 0.5 * mains
+    return signals
+
+
+def generate_selene_db(path, n_sessions=34, duration_s=32.0, class_weights=(1, 1, 1, 1), seed=0,
+                       sampling_rate=SAMPLING_RATE, overwrite=False):
+    if os.path.exists(path):
+        if not overwrite:
+            raise FileExistsError(f"{path} already exists")
+        os.remove(path)
+
+    rng = np.random.default_rng(seed)
+    labels = session_labels(n_sessions, class_weights, rng)
+    n_samples = int(round(duration_s * sampling_rate))
+    step_ms = 1000.0 / sampling_rate
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute(f"PRAGMA user_version = {ROOM_DB_VERSION}")
+        conn.execute(CREATE_SAMPLE_EEG)
+
+        start = START_TIMESTAMP
+        for session_id, tiredness in enumerate(labels.tolist(), start=1):
+            signals = session_signals(rng, tiredness, n_samples, sampling_rate)
+            timestamps = start + np.round(np.arange(n_samples) * step_ms).astype(np.int64)
+            for begin in range(0, n_samples, INSERT_ROWS):
+                end = min(begin + INSERT_ROWS, n_samples)
+                count = end - begin
+                conn.executemany(INSERT_SAMPLE_EEG, zip(
+                    timestamps[begin:end].tolist(), *signals[:, begin:end].tolist(),
+                    [tiredness] * count, [session_id] * count))
+            conn.commit()
+            start = int(timestamps[-1]) + SESSION_GAP_MS if n_samples else start + SESSION_GAP_MS
+    finally:
+        conn.close()
+    return labels
@@ -0,0 +1,230 @@
+import os
+import time
+
+import numpy as np
+
+from finetune_sessions import split_finetune_data
+
+
+# Harness of the trainable .tflite (see export_tflite in addest.py) run as the app runs it:
+#   FineTuningService      one invoke of the "train" signature for every feature vector, N_EPOCHS times, in a new
+#                          shuffled order every epoch
+#   MentalWorkloadProcessor "predict" signature on the feature vectors
+# The interpreter is created once and the runners of all the signatures are cached, as the app keeps one
+# Interpreter for the whole service. Fine tuning is replayed on the training sessions of a split of the selene-db
+# features (see featurize_finetune_sessions), then the test sessions are scored by "predict" in batches of a fixed
+# size (the last one padded), so the input tensor is resized only once.
+# The same steps, in the same order, are run on a Keras SeleneModel with the weights the .tflite was exported from
+# and its backbone frozen, as export_tflite freezes it: losses and probabilities of the two are compared, with
+# per-invoke latency (percentiles), throughput and memory. The run passes only if the losses and probabilities differ
+# by at most LOSS_TOLERANCE and PROB_TOLERANCE and the predicted classes agree on at least MIN_AGREEMENT of the
+# test vectors.
+# Memory is the resident set size of the process: the interpreter allocates its tensors outside of Python, where
+# tracemalloc does not see them.
+#
+# "train", "save" and "load_weights" use Select TensorFlow ops (ReluGrad, Save, Restore): they run only if the Flex
+# delegate is linked in the interpreter or given with flex_delegate (path of libtensorflowlite_flex). Without it the
+# fine tuning is skipped and both models score the test sessions with the exported weights, but the run fails: the
+# app could not fine tune with this model and interpreter either.
+
+N_EPOCHS = 20  # FineTuningService.N_EPOCHS
+NUM_CLASSES = 4
+PREDICT_BATCH = 64
+LOSS_TOLERANCE = 1e-3  # float32 kernels of TFLite and TensorFlow differ in rounding, more after many steps
+PROB_TOLERANCE = 1e-3
+MIN_AGREEMENT = 0.99
+
+
+def _interpreter_module():
+    # LiteRT when installed, the interpreter bundled with TensorFlow otherwise
+    try:
+        from ai_edge_litert import interpreter
+        return interpreter.Interpreter, interpreter.load_delegate
+    except ImportError:
+        import tensorflow as tf
+        return tf.lite.Interpreter, tf.lite.experimental.load_delegate
+
+
+# Current resident set size of the process in bytes (peak, where /proc is not available)
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class TFLiteSeleneModel:
+
+    # required: signatures the file must have ("predict" only for the models of tflite_quantization.py)
+    def __init__(self, tflite_path, flex_delegate=None, required=("train", "predict")):
+        Interpreter, load_delegate = _interpreter_module()
+        delegates = [load_delegate(flex_delegate)] if flex_delegate else None
+        self.interpreter = Interpreter(model_path=tflite_path, experimental_delegates=delegates)
+        self.model_bytes = os.path.getsize(tflite_path)
+        self.runners = {name: self.interpreter.get_signature_runner(name)
+                        for name in self.interpreter.get_signature_list()}
+        missing = set(required) - set(self.runners)
+        if missing:
+            raise ValueError(f"{tflite_path} has no {', '.join(sorted(missing))} signature")
+
+    # Loss of one SGD step on x (1, 90) and its one-hot label y (1, 4)
+    def train(self, x, y):
+        return float(self.runners["train"](x=x, y=y)["loss"][0])
+
+    def predict_proba(self, x):
+        return self.runners["predict"](x=x)["output"]
+
+
+# Softmax probabilities of every vector of x with predict_function, batch_size vectors at a time.
+# Returns the probabilities and the latency of every call, after an untimed call that allocates the tensors of the
+# batch shape (tf.function tracing for Keras)
+def score_batches(predict_function, x, batch_size=PREDICT_BATCH):
+    probs = np.empty((len(x), NUM_CLASSES), dtype=np.float32)
+    batch = np.zeros((batch_size, x.shape[1]), dtype=np.float32)
+    predict_function(batch)
+    latencies = []
+    for start in range(0, len(x), batch_size):
+        stop = min(start + batch_size, len(x))
+        batch[:stop - start] = x[start:stop]
+        begin = time.perf_counter()
+        output = predict_function(batch)
+        latencies.append(time.perf_counter() - begin)
+        probs[start:stop] = output[:stop - start]
+    return probs, latencies
+
+
+# One train_function(x, y) call for every vector, in the order of every epoch. Returns the losses and latencies
+def replay_finetuning(train_function, x, y, order):
+    losses, latencies = [], []
+    for indices in order:
+        for i in indices:
+            begin = time.perf_counter()
+            losses.append(train_function(x[i:i + 1], y[i:i + 1]))
+            latencies.append(time.perf_counter() - begin)
+    return np.array(losses, dtype=np.float32), latencies
+
+
+def latency_stats(latencies, items):
+    latencies = np.asarray(latencies)
+    total = latencies.sum()
+    return {
+        "invokes": len(latencies),
+        "total_s": float(total),
+        "mean_ms": float(latencies.mean() * 1e3),
+        "p50_ms": float(np.percentile(latencies, 50) * 1e3),
+        "p90_ms": float(np.percentile(latencies, 90) * 1e3),
+        "p99_ms": float(np.percentile(latencies, 99) * 1e3),
+        "max_ms": float(latencies.max() * 1e3),
+        "items_per_s": items / total if total > 0 else 0.0,
+    }
+
+
+def _is_missing_flex(error):
+    return "Select TensorFlow op" in str(error) or "Flex" in str(error)
+
+
+def run_harness(tflite_path, model_path, finetune_data, seed=None, epochs=N_EPOCHS, batch_size=PREDICT_BATCH,
+                flex_delegate=None):
+    x_ft, y_ft_raw, x_test, y_test_raw = split_finetune_data(finetune_data, seed)
+    x_ft, x_test = x_ft.astype(np.float32), x_test.astype(np.float32)
+    y_ft = np.eye(NUM_CLASSES, dtype=np.float32)[np.asarray(y_ft_raw) % NUM_CLASSES]
+    y_true = np.asarray(y_test_raw) % NUM_CLASSES
+    rng = np.random.default_rng(seed)
+    order = [rng.permutation(len(x_ft)) for _ in range(epochs)]
+    report = {"tflite": {}, "keras": {}, "finetune_vectors": len(x_ft), "test_vectors": len(x_test), "epochs": epochs}
+
+    # TFLite first, so its memory is not mixed with the one of the Keras model. The interpreter module is imported
+    # before, its import (all of TensorFlow, without LiteRT) is not part of loading the model
+    _interpreter_module()
+    rss_start = rss_bytes()
+    begin = time.perf_counter()
+    tflite_model = TFLiteSeleneModel(tflite_path, flex_delegate)
+    tflite = report["tflite"]
+    tflite["load_s"] = time.perf_counter() - begin
+    tflite["model_bytes"] = tflite_model.model_bytes
+    tflite["rss_load_bytes"] = rss_bytes() - rss_start
+
+    tflite_losses = None
+    try:
+        tflite_losses, latencies = replay_finetuning(tflite_model.train, x_ft, y_ft, order)
+        tflite["train"] = latency_stats(latencies, len(latencies))
+    except RuntimeError as error:
+        if not _is_missing_flex(error):
+            raise
+        tflite["train_error"] = str(error).splitlines()[0]
+        # The weights of the interpreter are untouched: compare the exported weights without fine tuning
+        order = []
+    tflite_probs, latencies = score_batches(tflite_model.predict_proba, x_test, batch_size)
+    tflite["predict"] = latency_stats(latencies, len(x_test))
+    tflite["rss_bytes"] = rss_bytes() - rss_start
+
+    from addest import BACKBONE_LAYERS, SeleneModel
+    from numpy_model import import_npz
+
+    keras_model = SeleneModel(inputShape=(x_ft.shape[1],), numClasses=NUM_CLASSES)
+    import_npz(keras_model, model_path)
+    keras_model.set_trainable(BACKBONE_LAYERS, False)
+    keras = report["keras"]
+    keras_losses, latencies = replay_finetuning(
+        lambda x, y: float(keras_model.train(x, y)["loss"].numpy()[0]), x_ft, y_ft, order)
+    if order:
+        keras["train"] = latency_stats(latencies, len(latencies))
+    keras_probs, latencies = score_batches(lambda x: keras_model.predict(x)["output"].numpy(), x_test, batch_size)
+    keras["predict"] = latency_stats(latencies, len(x_test))
+
+    tflite_pred, keras_pred = np.argmax(tflite_probs, axis=1), np.argmax(keras_probs, axis=1)
+    comparison = report["comparison"] = {
+        "finetuned": tflite_losses is not None,
+        "max_loss_diff": float(np.max(np.abs(tflite_losses - keras_losses))) if tflite_losses is not None else None,
+        "final_loss_tflite": float(tflite_losses[-1]) if tflite_losses is not None else None,
+        "final_loss_keras": float(keras_losses[-1]) if tflite_losses is not None else None,
+        "max_prob_diff": float(np.max(np.abs(tflite_probs - keras_probs))) if len(x_test) else 0.0,
+        "prediction_agreement": float(np.mean(tflite_pred == keras_pred)) if len(x_test) else 1.0,
+        "accuracy_tflite": float(np.mean(tflite_pred == y_true)) if len(x_test) else 0.0,
+        "accuracy_keras": float(np.mean(keras_pred == y_true)) if len(x_test) else 0.0,
+    }
+    failures = []
+    if tflite_losses is None:
+        failures.append("the train signature could not run, give the Flex delegate library with --flex-delegate")
+    elif comparison["max_loss_diff"] > LOSS_TOLERANCE:
+        failures.append(f"max loss difference {comparison['max_loss_diff']:.3g} > {LOSS_TOLERANCE:g}")
+    if comparison["max_prob_diff"] > PROB_TOLERANCE:
+        failures.append(f"max probability difference {comparison['max_prob_diff']:.3g} > {PROB_TOLERANCE:g}")
+    if comparison["prediction_agreement"] < MIN_AGREEMENT:
+        failures.append(f"same prediction on {comparison['prediction_agreement']:.1%} < {MIN_AGREEMENT:.0%}")
+    report["failures"] = failures
+    report["passed"] = not failures
+    return report
+
+
+def print_report(report):
+    print(f"{report['finetune_vectors']} fine tuning vectors x {report['epochs']} epochs, "
+          f"{report['test_vectors']} test vectors")
+    tflite = report["tflite"]
+    print(f"TFLite model: {tflite['model_bytes'] / 2 ** 10:.1f} KB, loaded in {tflite['load_s'] * 1e3:.1f} ms, "
+          f"RSS +{tflite['rss_load_bytes'] / 2 ** 20:.1f} MB after loading, "
+          f"+{tflite['rss_bytes'] / 2 ** 20:.1f} MB after the runs")
+    if "train_error" in tflite:
+        print(f"TFLite train not run, fine tuning skipped: {tflite['train_error']}")
+
+    print(f"{'signature':<20}{'invokes':>9}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+          f"{'max ms':>10}{'items/s':>12}")
+    for model in ("tflite", "keras"):
+        for signature in ("train", "predict"):
+            row = report[model].get(signature)
+            if row is None:
+                continue
+            print(f"{model + ' ' + signature:<20}{row['invokes']:>9}{row['mean_ms']:>10.3f}{row['p50_ms']:>10.3f}"
+                  f"{row['p90_ms']:>10.3f}{row['p99_ms']:>10.3f}{row['max_ms']:>10.3f}{row['items_per_s']:>12.0f}")
+
+    comparison = report["comparison"]
+    if comparison["finetuned"]:
+        print(f"Max loss difference over the steps: {comparison['max_loss_diff']:.3g} "
+              f"(last step {comparison['final_loss_tflite']:.4f} TFLite, {comparison['final_loss_keras']:.4f} Keras)")
+    print(f"Max probability difference: {comparison['max_prob_diff']:.3g}, "
+          f"same prediction on {comparison['prediction_agreement']:.1%} of the test vectors")
+    print(f"Accuracy: {comparison['accuracy_tflite']:.4f} TFLite, {comparison['accuracy_keras']:.4f} Keras")
+    for failure in report["failures"]:
+        print(f"FAILED: {failure}")
@@ -0,0 +1,141 @@
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from tflite_harness import TFLiteSeleneModel, latency_stats
+
+
+# Builtins-only .tflite models of the "predict" signature of SeleneModel, float32 or post-training quantized.
+#
+# The trainable model of export_tflite (addest.py) needs SELECT_TF_OPS for train, save and load_weights, so the app
+# links the Flex delegate, which makes the binary bigger and the interpreter slower to load. A model that only
+# predicts needs none of them: export_predict_tflite writes it with TFLITE_BUILTINS only and the weights frozen as
+# constants, with one of the QUANTIZATIONS:
+#   int8     weights of hl1 and hl2 in int8, one scale per unit (hl3 and tail are under the 1024 weights the
+#            converter quantizes), activations in float32: the interpreter quantizes the input of every layer on the
+#            fly with its own range. Full integer quantization, with fixed int8 ranges calibrated on the training
+#            vectors, is not usable for this model: the 90 features span five orders of magnitude (band powers and
+#            ratios), one int8 scale for the input and for the hl1 activations keeps only the largest ones, and the
+#            predicted class changed on up to a third of the vectors (still a few percent with hl1 left in float)
+#   float16  weights stored as float16 and expanded to float32 when the interpreter loads them
+# Input and output stay float32 in both, so the app calls them as the float model.
+# run_quantization_report compares every variant with the float trainable model on the test split of every cross
+# validation stage: accuracy, agreement with the float predictions, per-inference latency (one vector per invoke,
+# as MentalWorkloadProcessor), size of the file and load time of the interpreter. A variant is usable when it
+# predicts the class of the float model on at least MIN_AGREEMENT of the test vectors of every stage.
+
+QUANTIZATIONS = ("int8", "float16")
+LOAD_REPEAT = 5  # interpreter loads timed for every model, the median is reported
+MIN_AGREEMENT = 0.99
+
+
+def export_predict_tflite(model, tflite_path, quantization=None, saved_model_dir="saved_model_predict"):
+    if quantization not in (None,) + QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization!r} (available: {', '.join(QUANTIZATIONS)})")
+
+    # Keras 3 wraps every tf.Variable: the underlying ones are tracked on the module, so the converter finds them
+    model.tflite_variables = [variable.value for variable in model.model.weights]
+    tf.saved_model.save(model, saved_model_dir, signatures={"predict": model.predict})
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS]
+    if quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        # Without a representative dataset the converter quantizes the weights only (dynamic range quantization)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    tflite_model = converter.convert()
+    with open(tflite_path, "wb") as f:
+        f.write(tflite_model)
+    print(f"Model converted in {tflite_path} ({quantization or 'float32'}, {len(tflite_model) / 2 ** 10:.1f} KB)")
+
+
+# Size, median load time, per-inference latency and probabilities of the "predict" signature of a .tflite on x
+def measure_predict_tflite(tflite_path, x, load_repeat=LOAD_REPEAT):
+    load_times = []
+    for _ in range(load_repeat):
+        begin = time.perf_counter()
+        tflite_model = TFLiteSeleneModel(tflite_path, required=("predict",))
+        load_times.append(time.perf_counter() - begin)
+
+    x = np.asarray(x, dtype=np.float32)
+    probs = np.empty((len(x), 4), dtype=np.float32)
+    latencies = []
+    for i in range(len(x)):
+        begin = time.perf_counter()
+        probs[i] = tflite_model.predict_proba(x[i:i + 1])[0]
+        latencies.append(time.perf_counter() - begin)
+
+    return {"bytes": tflite_model.model_bytes, "load_ms": float(np.median(load_times) * 1e3),
+            "predict": latency_stats(latencies, len(x))}, probs
+
+
+# Float trainable model and the QUANTIZATIONS of model, written in out_dir and measured on the test split of data
+def compare_stage(model, data, out_dir, name):
+    os.makedirs(out_dir, exist_ok=True)
+    from addest import export_tflite
+
+    float_path = os.path.join(out_dir, f"{name}_trainable.tflite")
+    export_tflite(model, float_path, os.path.join(out_dir, "saved_model"))
+    x_test = data["X_test"].astype(np.float32)
+    y_true = np.argmax(data["y_test"], axis=1)
+
+    float_result, float_probs = measure_predict_tflite(float_path, x_test)
+    results = {"float32": float_result}
+    all_probs = {"float32": float_probs}
+    for quantization in QUANTIZATIONS:
+        path = os.path.join(out_dir, f"{name}_predict_{quantization}.tflite")
+        export_predict_tflite(model, path, quantization, os.path.join(out_dir, "saved_model_predict"))
+        results[quantization], all_probs[quantization] = measure_predict_tflite(path, x_test)
+
+    for variant, result in results.items():
+        y_pred = np.argmax(all_probs[variant], axis=1)
+        result["accuracy"] = float(np.mean(y_pred == y_true)) if len(y_true) else 0.0
+        result["agreement"] = float(np.mean(y_pred == np.argmax(float_probs, axis=1))) if len(y_true) else 1.0
+        result["max_prob_diff"] = float(np.max(np.abs(all_probs[variant] - float_probs))) if len(y_true) else 0.0
+        result["usable"] = result["agreement"] >= MIN_AGREEMENT
+    return results
+
+
+# Every stage (fold) is trained as in cross validation, unless model_path gives the weights (.npz) of one trained
+# model, then compared by compare_stage. Returns {"stages": {fold: results}, "mean": results averaged over stages}
+def run_quantization_report(folds=10, out_dir="quantized", model_path=None, epochs=100, patience=10, seed=None):
+    from addest import NUM_CLASSES, SeleneModel, load_fold_data, run_training
+    from numpy_model import import_npz
+
+    stages = {}
+    for fold in range(folds):
+        data = load_fold_data(fold)
+        model = SeleneModel(inputShape=(data["X_train"].shape[1],), numClasses=NUM_CLASSES)
+        if model_path is not None:
+            import_npz(model, model_path)
+        else:
+            run_training(model, data["X_train"].astype(np.float32), data["y_train"].astype(np.float32),
+                         data["X_val"].astype(np.float32), data["y_val"].astype(np.float32),
+                         batch_size=1, epochs=epochs, patience=patience, compiled=True, seed=seed, log_every=0)
+        stages[fold] = compare_stage(model, data, out_dir, f"stage_{fold}")
+
+    mean = {}
+    for variant in stages[0]:
+        rows = [results[variant] for results in stages.values()]
+        mean[variant] = {key: float(np.mean([row[key] for row in rows]))
+                         for key in ("bytes", "load_ms", "accuracy", "agreement", "max_prob_diff")}
+        for key in ("mean_ms", "p50_ms", "p99_ms"):
+            mean[variant][key] = float(np.mean([row["predict"][key] for row in rows]))
+        mean[variant]["usable"] = all(row["usable"] for row in rows)
+    return {"stages": stages, "mean": mean}
+
+
+def print_quantization_report(report):
+    header = (f"{'stage':<8}{'model':<10}{'KB':>8}{'load ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'accuracy':>10}"
+              f"{'agreement':>11}{'max prob diff':>15}{'usable':>8}")
+    print(header)
+    rows = [(str(fold), results) for fold, results in report["stages"].items()] + [("mean", report["mean"])]
+    for stage_name, results in rows:
+        for variant, result in results.items():
+            latency = result.get("predict", result)
+            print(f"{stage_name:<8}{variant:<10}{result['bytes'] / 2 ** 10:>8.1f}{result['load_ms']:>10.3f}"
+                  f"{latency['p50_ms']:>10.4f}{latency['p99_ms']:>10.4f}{result['accuracy']:>10.4f}"
+                  f"{result['agreement']:>11.2%}{result['max_prob_diff']:>15.3g}{'yes' if result['usable'] else 'NO':>8}")
@@ -0,0 +1,200 @@
+import numpy as np
+from functools import lru_cache
+from math import cos, pi
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import rfft
+
+from instrumentation import instrumented
+
+
+# Batched Welch PSD for (channels, samples) or (blocks, channels, samples) signals (any leading shape works).
+# The PSD is computed along the last axis and has shape (..., segment_length // 2 + 1).
+#
+# Two modes:
+# - parity=True gives the same numbers, bit for bit, as the per-segment loop of compute_welch_psd (the Python
+#   translation of the Kotlin EegFeatureExtractor): each segment is zero padded to 2 * segment_length before the
+#   FFT and the first segment_length // 2 + 1 bins are used, but they are labelled with the frequencies of a
+#   segment_length FFT (bin j is really at j * fs / (2 * segment_length)). The model of the app is trained on
+#   these values, so this mode must be used for the features given to it.
+# - parity=False is a standard Welch estimate, without zero padding, so the FFTs are half as long and bin j is
+#   really at j * fs / segment_length. Same window, overlap and scaling.
+
+SEGMENT_LENGTH = 2000  # 4 second window at 500 Hz sampling rate
+
+
+# Same values as EegFeatureExtractor.hamming_window, computed only once for each length
+@lru_cache(maxsize=None)
+def hamming_window(N):
+    window = np.array([0.54 - 0.46 * cos(2.0 * pi * i / (N - 1)) for i in range(N)])
+    window.setflags(write=False)
+    return window
+
+
+# Power spectra of the (..., segment_length) segments: Hamming window, FFT and Welch scaling, not yet averaged
+def segment_power(segments, sampling_rate, segment_length=SEGMENT_LENGTH, parity=True):
+    window = hamming_window(segment_length)
+    window_power = np.sum(window ** 2) / segment_length
+    n_bins = segment_length // 2 + 1
+
+    # A single batched real FFT over all segments
+    n_fft = segment_length * 2 if parity else segment_length
+    fft_result = rfft(segments * window, n=n_fft, axis=-1)[..., :n_bins]
+    re = fft_result.real
+    im = fft_result.imag
+    return (re * re + im * im) / (segment_length * sampling_rate * window_power)
+
+
+def welch_freqs(sampling_rate, segment_length=SEGMENT_LENGTH):
+    return np.arange(segment_length // 2 + 1) * sampling_rate / segment_length
+
+
+@instrumented("welch")
+def welch_psd(signals, sampling_rate, segment_length=SEGMENT_LENGTH, parity=True):
+    signals = np.asarray(signals, dtype=np.float64)
+    overlap = segment_length // 2
+    step = segment_length - overlap
+
+    num_segments = (signals.shape[-1] - overlap) // step
+    if num_segments <= 0:
+        raise ValueError(f"Signal too short for Welch PSD: {signals.shape[-1]} samples, "
+                         f"at least {segment_length} needed")
+
+    # Every segment of every channel as a strided view: shape (..., num_segments, segment_length)
+    segments = sliding_window_view(signals, segment_length, axis=-1)[..., ::step, :][..., :num_segments, :]
+    power = segment_power(segments, sampling_rate, segment_length, parity)
+
+    if parity:
+        # The loop adds the segments one after the other: cumsum keeps the same summation order
+        psd = np.cumsum(power, axis=-2)[..., -1, :]
+    else:
+        psd = np.sum(power, axis=-2)
+    psd /= num_segments
+
+    return welch_freqs(sampling_rate, segment_length), psd
+
+
+# --- Welch PSD of overlapping windows (workload timelines over long sessions) ---
+#
+# Windows of window_length samples moving by hop samples share most of their segments when hop is a multiple of
+# the segment step (segment_length // 2): every segment is transformed only once and each window averages the
+# power spectra of its own segments, so a new window costs hop // step segment FFTs instead of all of them.
+# The PSD of every window is the one welch_psd gives for that window alone: with parity=True the spectra are
+# added in the same order, so the values are identical bit for bit; with parity=False the spectra of every window
+# are summed on their own (same values up to rounding). A running sum, adding the new segments and removing the
+# oldest ones, would lose the precision of the quiet windows that follow a segment of high power.
+# Both versions return the same windows: window k is complete when k * hop + window_length samples are available,
+# also when window_length is not a multiple of the segment step and its last samples are in no segment.
+
+
+def _check_sliding(window_length, hop, segment_length):
+    step = segment_length - segment_length // 2
+    num_segments = (window_length - segment_length // 2) // step
+    if num_segments <= 0:
+        raise ValueError(f"Window too short for Welch PSD: {window_length} samples, at least {segment_length} needed")
+    if hop <= 0 or hop % step != 0:
+        raise ValueError(f"hop must be a positive multiple of the segment step {step}, got {hop}")
+    return step, num_segments, hop // step
+
+
+def sliding_window_count(n_samples, window_length, hop):
+    return max(0, (n_samples - window_length) // hop + 1)
+
+
+# PSD of every window of a whole signal, shape (n_windows, ..., n_bins) (windows start at 0, hop, 2 * hop, ...)
+@instrumented("welch")
+def sliding_welch_psd(signals, sampling_rate, window_length, hop, segment_length=SEGMENT_LENGTH, parity=True):
+    signals = np.asarray(signals, dtype=np.float64)
+    step, num_segments, segments_per_hop = _check_sliding(window_length, hop, segment_length)
+    n_windows = sliding_window_count(signals.shape[-1], window_length, hop)
+    n_bins = segment_length // 2 + 1
+    if n_windows <= 0:
+        return welch_freqs(sampling_rate, segment_length), np.zeros((0,) + signals.shape[:-1] + (n_bins,))
+
+    # All the segments used by the windows, each transformed once: (..., total_segments, n_bins)
+    total_segments = (n_windows - 1) * segments_per_hop + num_segments
+    segments = sliding_window_view(signals, segment_length, axis=-1)[..., ::step, :][..., :total_segments, :]
+    power = segment_power(segments, sampling_rate, segment_length, parity)
+
+    starts = np.arange(n_windows) * segments_per_hop
+    if parity:
+        psd = power[..., starts, :]
+        for j in range(1, num_segments):
+            psd = psd + power[..., starts + j, :]
+    else:
+        # (..., n_windows, n_bins, num_segments) view of the segments of every window
+        psd = sliding_window_view(power, num_segments, axis=-2)[..., starts, :, :].sum(axis=-1)
+    psd /= num_segments
+
+    return welch_freqs(sampling_rate, segment_length), np.moveaxis(psd, -2, 0)
+
+
+# Streaming version of sliding_welch_psd, fed with chunks of shape (..., k): the power spectra of the last
+# num_segments segments are kept in a ring buffer, and every hop samples the PSD of the window just completed is
+# returned. A PSD computed when the last segment of its window is complete is held until the window_length samples
+# of the window have arrived. Memory is bounded by the ring plus one segment of samples, whatever the session length.
+class SlidingWelch:
+
+    def __init__(self, sampling_rate, window_length, hop, segment_length=SEGMENT_LENGTH, parity=True):
+        self.sampling_rate = sampling_rate
+        self.window_length = window_length
+        self.hop = hop
+        self.segment_length = segment_length
+        self.parity = parity
+        self.step, self.num_segments, self.segments_per_hop = _check_sliding(window_length, hop, segment_length)
+        self.freqs = welch_freqs(sampling_rate, segment_length)
+        self.reset()
+
+    def reset(self):
+        self._samples = None  # samples of the next segment not yet complete
+        self._ring = None  # (num_segments, ..., n_bins) power spectra, slot = segment index % num_segments
+        self._segments = 0  # segments transformed so far
+        self._received = 0  # samples pushed so far
+        self._pending = []  # (window index, PSD) of the windows whose last samples have not arrived yet
+        self.windows = 0  # windows returned so far
+
+    # PSDs of the windows completed by this chunk, shape (n_windows, ..., n_bins)
+    def push(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        samples = chunk if self._samples is None else np.concatenate([self._samples, chunk], axis=-1)
+        self._received += chunk.shape[-1]
+        n_new = max(0, (samples.shape[-1] - self.segment_length) // self.step + 1)
+        if n_new:
+            segments = sliding_window_view(samples, self.segment_length, axis=-1)[..., ::self.step, :][..., :n_new, :]
+            power = np.moveaxis(segment_power(segments, self.sampling_rate, self.segment_length, self.parity), -2, 0)
+            if self._ring is None:
+                self._ring = np.zeros((self.num_segments,) + power.shape[1:])
+            for spectrum in power:
+                window = self._add_segment(spectrum)
+                if window is not None:
+                    self._pending.append(window)
+            samples = samples[..., n_new * self.step:]
+        self._samples = samples.copy()
+
+        psds = []
+        while self._pending and self._pending[0][0] * self.hop + self.window_length <= self._received:
+            psds.append(self._pending.pop(0)[1])
+        self.windows += len(psds)
+
+        if not psds:
+            n_bins = self.segment_length // 2 + 1
+            return np.zeros((0,) + chunk.shape[:-1] + (n_bins,))
+        return np.stack(psds)
+
+    def _add_segment(self, power):
+        self._ring[self._segments % self.num_segments] = power
+        self._segments += 1
+
+        # Window k ends with segment k * segments_per_hop + num_segments - 1
+        last = self._segments - 1
+        window, offset = divmod(last - (self.num_segments - 1), self.segments_per_hop)
+        if last < self.num_segments - 1 or offset:
+            return None
+        if not self.parity:
+            return window, np.sum(self._ring, axis=0) / self.num_segments
+
+        # Oldest to newest, in the order of welch_psd
+        first = self._segments - self.num_segments
+        psd = self._ring[first % self.num_segments].copy()
+        for index in range(first + 1, self._segments):
+            psd = psd + self._ring[index % self.num_segments]
+        return window, psd / self.num_segments
@@ -1,11 +1,14 @@
 import os
+import sys
 import numpy as np
-import pandas as pd
 import tensorflow as tf
 from sklearn.metrics import accuracy_score, precision_score, recall_score
 from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import confusion_matrix, classification_report
-from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "Cross Validation Scripts"))
+from feature_store import load_split
+from tflite_quantization import export_predict_tflite
 
 
 # --- Dataset Pre Processing ---
@@ -18,42 +21,14 @@ SELECTED_FEATURES = [
     "Spectral_Entropy", "Rel_alpha_Power", "Theta_Alpha_to_Beta_Ratio", "Abs_delta_Power"
 ]
 DATA_PATH = './'
+PARSE_WORKERS = 1  # processes parsing the .xlsx files of a split when its feature store is compiled (feature_store.py)
 
-def load_data_from_folder(folder_path):
-    X_list = []
-    y_list = []
-
+def load_data_from_folder(folder_path, workers=PARSE_WORKERS):
     labels_file = os.path.join(DATA_PATH, f"{folder_path}_labels.csv")
-    labels_df = pd.read_csv(labels_file, skiprows=1, header=None, names=["file", "label"])
-    label_dict = dict(zip(labels_df["file"], labels_df["label"]))
-
     folder_full_path = os.path.join(DATA_PATH, folder_path)
-    file_names = [f for f in os.listdir(folder_full_path) if f.endswith('.xlsx')]
-
-    for file_name in tqdm(file_names, desc=f"Loading {folder_path} data"):
-        file_path = os.path.join(folder_full_path, file_name)
-
-        if file_name not in label_dict:
-            print(f"{file_name} skipped (no label).")
-            continue
-
-        df_full = pd.read_excel(file_path, engine='openpyxl')
 
-        # Taking only the  SELECTED_FEATURES (that matrix has 29 feature, we use only the best 15)
-        selected_cols = [col for col in df_full.columns if col in SELECTED_FEATURES]
-
-        # Line from 2 to 7 (this function starts count from 0, excel from 1)
-        df_selected = df_full.loc[0:, selected_cols]
-
-        data_array = df_selected.values
-        if data_array.shape != (INPUT_ROWS, len(SELECTED_FEATURES)):
-            raise ValueError(f"{file_name} shape mismatch: {data_array.shape}")
-
-        X_list.append(data_array.flatten())
-        y_list.append(label_dict[file_name])
-
-    X = np.array(X_list)
-    y = np.array(y_list)
+    # The .xlsx files are compiled once into a memory-mapped store, rebuilt when they change (see feature_store.py)
+    X, y, _ = load_split(folder_full_path, labels_file, SELECTED_FEATURES, INPUT_ROWS, workers)
     return X, y
 
 # Label processing
@@ -82,6 +57,12 @@ class SeleneModel(tf.Module):
         tf.TensorSpec([None, 4], tf.float32),
     ])
     def train(self, x, y):
+        loss = self.train_step(x, y)
+        reshaped_loss = tf.reshape(loss,[1])
+        return {"loss": reshaped_loss}
+
+    # One SGD step on a batch, shared by train and train_epoch
+    def train_step(self, x, y):
         with tf.GradientTape() as tape:
             logits = self.model(x, training=True)
             loss = tf.reduce_mean(
@@ -90,8 +71,21 @@ class SeleneModel(tf.Module):
         gradients = tape.gradient(loss, self.model.trainable_variables)
         clipped_gradients = [tf.clip_by_norm(g, 1.0) for g in gradients]
         self.optimizer.apply_gradients(zip(clipped_gradients, self.model.trainable_variables))
-        reshaped_loss = tf.reshape(loss,[1])
-        return {"loss": reshaped_loss}
+        return loss
+
+    # A whole epoch of batch_size=1 steps (the same updates of calling train once per sample) in a single graph,
+    # without going back to python between samples. Returns the loss of every step
+    @tf.function(input_signature=[
+        tf.TensorSpec([None, 90], tf.float32),
+        tf.TensorSpec([None, 4], tf.float32),
+    ])
+    def train_epoch(self, x, y):
+        n = tf.shape(x)[0]
+        losses = tf.TensorArray(tf.float32, size=n)
+        for i in tf.range(n):
+            loss = self.train_step(x[i:i + 1], y[i:i + 1])
+            losses = losses.write(i, loss)
+        return {"loss": losses.stack()}
 
     @tf.function(input_signature=[
         tf.TensorSpec([None, 90], tf.float32),
@@ -103,8 +97,9 @@ class SeleneModel(tf.Module):
 
     @tf.function(input_signature=[tf.TensorSpec(shape=[], dtype=tf.string)])
     def save(self, checkpoint_path):
-        tensor_names = [weight.name for weight in self.model.weights]
-        tensors_to_save = [weight.read_value() for weight in self.model.weights]
+        # path (Keras 3) is the unique name of a weight, name is the last part only; tf.Variable has no path
+        tensor_names = [getattr(weight, "path", weight.name) for weight in self.model.weights]
+        tensors_to_save = [tf.convert_to_tensor(weight) for weight in self.model.weights]
         tf.raw_ops.Save(
             filename=checkpoint_path,
             tensor_names=tensor_names,
@@ -118,33 +113,53 @@ class SeleneModel(tf.Module):
         for var in self.model.weights:
             restored = tf.raw_ops.Restore(
                 file_pattern=checkpoint_path,
-                tensor_name=var.name,
-                dt=var.dtype
+                tensor_name=getattr(var, "path", var.name),
+                dt=tf.as_dtype(var.dtype)
             )
+            # Restore gives a tensor of unknown shape, Keras 3 variables only accept a known one
+            restored = tf.reshape(restored, var.shape)
             var.assign(restored)
-            restored_tensors[var.name] = restored
+            restored_tensors[getattr(var, "path", var.name)] = restored
         return restored_tensors
     
 #function for loop training
-def run_training(model, x_train, y_train, x_val=None, y_val=None, batch_size=1, epochs=10, patience=3):
+# compiled=True (only with batch_size=1) runs every epoch with model.train_epoch, in a single graph: the samples are
+# taken in the same shuffled order, so with the same seed the weights are the same of the step by step loop.
+# Step losses are printed every log_every steps (0 to print only the epoch averages).
+def run_training(model, x_train, y_train, x_val=None, y_val=None, batch_size=1, epochs=10, patience=3,
+                 compiled=False, seed=None, log_every=1):
+    if compiled and batch_size != 1:
+        raise ValueError("compiled training is available only with batch_size=1")
+
     dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-    dataset = dataset.shuffle(buffer_size=len(x_train)).batch(batch_size)
+    dataset = dataset.shuffle(buffer_size=len(x_train), seed=seed).batch(batch_size)
+    # Same shuffle of the dataset above, on the indexes of the samples
+    order = tf.data.Dataset.range(len(x_train)).shuffle(buffer_size=len(x_train), seed=seed).batch(len(x_train))
+    if compiled:
+        # Optimizer variables must exist before the first graph that updates them
+        model.optimizer.build(model.model.trainable_variables)
 
     best_val_loss = float('inf')
     patience_counter = 0
 
     for epoch in range(epochs):
         print(f"\nEpoch {epoch + 1}/{epochs}")
-        epoch_loss = []
 
-        for step, (batch_x, batch_y) in enumerate(dataset):
-            result = model.train(batch_x, batch_y)
-            batch_loss = result["loss"].numpy()
-            epoch_loss.append(batch_loss)
-            print(f"  Step {step + 1}: loss = {batch_loss.item():.4f}")
+        if compiled:
+            indexes = next(iter(order))
+            epoch_loss = model.train_epoch(tf.gather(x_train, indexes), tf.gather(y_train, indexes))["loss"].numpy()
+        else:
+            epoch_loss = []
+            for batch_x, batch_y in dataset:
+                epoch_loss.append(model.train(batch_x, batch_y)["loss"].numpy().item())
+            epoch_loss = np.array(epoch_loss)
 
-        avg_loss = sum(epoch_loss) / len(epoch_loss)
-        print(f"Epoch {epoch + 1} average training loss: {avg_loss.item():.4f}")
+        if log_every:
+            for step in range(0, len(epoch_loss), log_every):
+                print(f"  Step {step + 1}: loss = {epoch_loss[step]:.4f}")
+
+        avg_loss = np.mean(epoch_loss)
+        print(f"Epoch {epoch + 1} average training loss: {avg_loss:.4f}")
 
         # Early stopping code, checking for validation data
         if x_val is not None and y_val is not None:
@@ -234,7 +249,8 @@ if __name__ == "__main__":
     model = SeleneModel(inputShape=(X_train.shape[1],), numClasses=NUM_CLASSES)
     run_training(model, X_train.astype(np.float32), y_train.astype(np.float32),
                  X_val.astype(np.float32), y_val.astype(np.float32),
-                 batch_size=1, epochs=10000, patience=200) # batch size = 1 because our app use one array at time
+                 batch_size=1, epochs=10000, patience=200, # batch size = 1 because our app use one array at time
+                 compiled=True, log_every=100)
 
     # Freezing the layers in order to can perform fine tuning 
     model.model.get_layer('head').trainable = False
@@ -245,6 +261,9 @@ if __name__ == "__main__":
     evaluate_model(model, X_test.astype(np.float32), y_test.astype(np.float32))
 
     # Saving the model as .tflite
+    # The converter initializes only the variables the SavedModel tracks as such: Keras 3 wraps every tf.Variable,
+    # so the underlying ones of the weights and of the optimizer are tracked on the module too
+    model.tflite_variables = [variable.value for variable in model.model.weights + model.optimizer.variables]
     tf.saved_model.save(model, "saved_model", signatures={
         "train": model.train,
         "predict": model.predict,
@@ -260,6 +279,10 @@ if __name__ == "__main__":
         f.write(tflite_model)
     print("Modello convertito in trainable_model.tflite")
 
+    # Builtins-only predict model (no Flex delegate) with float16 weights. The int8 one is written by
+    # "selene_cli.py export-tflite --quantize int8" once "selene_cli.py quant-report" shows it usable on the stages
+    export_predict_tflite(model, "predict_float16.tflite", "float16")
+
 #STEPS PERFORMED
 # 1. Model declaration
 # 2. Training with early stopping
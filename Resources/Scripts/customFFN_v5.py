@@ -42,8 +42,9 @@ class SeleneModel(tf.Module):
 
     @tf.function(input_signature=[tf.TensorSpec(shape=[], dtype=tf.string)])
     def save(self, checkpoint_path):
-        tensor_names = [weight.name for weight in self.model.weights]
-        tensors_to_save = [weight.read_value() for weight in self.model.weights]
+        # path (Keras 3) is the unique name of a weight, name is the last part only; tf.Variable has no path
+        tensor_names = [getattr(weight, "path", weight.name) for weight in self.model.weights]
+        tensors_to_save = [tf.convert_to_tensor(weight) for weight in self.model.weights]
         tf.raw_ops.Save(
             filename=checkpoint_path,
             tensor_names=tensor_names,
@@ -57,11 +58,13 @@ class SeleneModel(tf.Module):
         for var in self.model.weights:
             restored = tf.raw_ops.Restore(
                 file_pattern=checkpoint_path,
-                tensor_name=var.name,
-                dt=var.dtype
+                tensor_name=getattr(var, "path", var.name),
+                dt=tf.as_dtype(var.dtype)
             )
+            # Restore gives a tensor of unknown shape, Keras 3 variables only accept a known one
+            restored = tf.reshape(restored, var.shape)
             var.assign(restored)
-            restored_tensors[var.name] = restored
+            restored_tensors[getattr(var, "path", var.name)] = restored
         return restored_tensors
     
 #function for loop training using batches
@@ -115,6 +118,9 @@ model.model.get_layer('hl1').trainable = False
 model.model.get_layer('hl2').trainable = False
 
 # Save the model with signatures, signatures are method that can be called also from the tf lite model
+# The converter initializes only the variables the SavedModel tracks as such: Keras 3 wraps every tf.Variable,
+# so the underlying ones of the weights and of the optimizer are tracked on the module too
+model.tflite_variables = [variable.value for variable in model.model.weights + model.optimizer.variables]
 tf.saved_model.save(model, "saved_model",
     signatures={
         "train": model.train,